@@ -156,19 +156,20 @@ class SUPIRModel(DiffusionEngine):
             samples = adaptive_instance_normalization(samples, x_stage1)
         return samples
 
-    def init_tile_vae(self, encoder_tile_size=512, decoder_tile_size=64):
+    def init_tile_vae(self, encoder_tile_size=512, decoder_tile_size=64, tile_batch_size=1,
+                      fast_encoder=False, fast_decoder=False, color_fix=False):
         self.first_stage_model.denoise_encoder.original_forward = self.first_stage_model.denoise_encoder.forward
         self.first_stage_model.encoder.original_forward = self.first_stage_model.encoder.forward
         self.first_stage_model.decoder.original_forward = self.first_stage_model.decoder.forward
         self.first_stage_model.denoise_encoder.forward = VAEHook(
             self.first_stage_model.denoise_encoder, encoder_tile_size, is_decoder=False, fast_decoder=False,
-            fast_encoder=False, color_fix=False, to_gpu=True)
+            fast_encoder=fast_encoder, color_fix=color_fix, to_gpu=True, tile_batch_size=tile_batch_size)
         self.first_stage_model.encoder.forward = VAEHook(
             self.first_stage_model.encoder, encoder_tile_size, is_decoder=False, fast_decoder=False,
-            fast_encoder=False, color_fix=False, to_gpu=True)
+            fast_encoder=fast_encoder, color_fix=color_fix, to_gpu=True, tile_batch_size=tile_batch_size)
         self.first_stage_model.decoder.forward = VAEHook(
-            self.first_stage_model.decoder, decoder_tile_size, is_decoder=True, fast_decoder=False,
-            fast_encoder=False, color_fix=False, to_gpu=True)
+            self.first_stage_model.decoder, decoder_tile_size, is_decoder=True, fast_decoder=fast_decoder,
+            fast_encoder=False, color_fix=False, to_gpu=True, tile_batch_size=tile_batch_size)
         
     def prepare_condition(self, _z, p, p_p, n_p, N):
         batch = {}
@@ -11,6 +11,7 @@ from ...sgm.modules.diffusionmodules.util import (
     checkpoint,
     conv_nd,
     linear,
+    memory_format,
     normalization,
     timestep_embedding,
     zero_module,
@@ -18,7 +19,8 @@ from ...sgm.modules.diffusionmodules.util import (
 
 from ...sgm.modules.diffusionmodules.openaimodel import Downsample, Upsample, UNetModel, Timestep, \
     TimestepEmbedSequential, ResBlock, AttentionBlock, TimestepBlock
-from ...sgm.modules.attention import SpatialTransformer, MemoryEfficientCrossAttention, CrossAttention
+from ...sgm.modules.attention import SpatialTransformer, MemoryEfficientCrossAttention, CrossAttention, cached_cast, \
+    cached_call, cached_step_state, chunked_scaled_dot_product_attention, sampling_tile
 from ...sgm.util import default, log_txt_as_img, exists, instantiate_from_config
 import re
 import torch
@@ -88,29 +90,50 @@ class ZeroSFT(nn.Module):
         self.zero_conv = zero_module(conv_nd(2, label_nc, norm_nc, 1, 1, 0))
         self.pre_concat = bool(concat_channels != 0)
         self.mask = mask
+        # zero_mul and zero_add folded into one conv by fuse(), inference only
+        self.zero_mul_add = None
+
+    def fuse(self):
+        """
+        Replaces zero_mul and zero_add with a single conv with doubled output channels,
+        call after the weights are loaded.
+        """
+        if self.zero_mul_add is not None:
+            return
+        with torch.no_grad():
+            fused = nn.Conv2d(self.zero_mul.in_channels, self.zero_mul.out_channels * 2,
+                              kernel_size=self.zero_mul.kernel_size, padding=self.zero_mul.padding,
+                              device=self.zero_mul.weight.device, dtype=self.zero_mul.weight.dtype)
+            fused.weight.copy_(th.cat([self.zero_mul.weight, self.zero_add.weight], dim=0))
+            fused.bias.copy_(th.cat([self.zero_mul.bias, self.zero_add.bias], dim=0))
+        fused.requires_grad_(False)
+        del self.zero_mul, self.zero_add
+        self.zero_mul_add = fused
 
     def forward(self, c, h, h_ori=None, control_scale=1):
         assert self.mask is False
-        if h_ori is not None and self.pre_concat:
-            h_raw = th.cat([h_ori, h], dim=1)
-        else:
-            h_raw = h
+        # the blend with the raw features is a no-op at control_scale 1
+        blend = control_scale != 1
+        if blend:
+            if h_ori is not None and self.pre_concat:
+                h_raw = th.cat([h_ori, h], dim=1)
+            else:
+                h_raw = h
 
-        if self.mask:
-            h = h + self.zero_conv(c) * torch.zeros_like(h)
-        else:
-            h = h + self.zero_conv(c)
+        h = h + self.zero_conv(c)
         if h_ori is not None and self.pre_concat:
             h = th.cat([h_ori, h], dim=1)
         actv = self.mlp_shared(c)
-        gamma = self.zero_mul(actv)
-        beta = self.zero_add(actv)
-        if self.mask:
-            gamma = gamma * torch.zeros_like(gamma)
-            beta = beta * torch.zeros_like(beta)
+        if self.zero_mul_add is not None:
+            gamma, beta = self.zero_mul_add(actv).chunk(2, dim=1)
+        else:
+            gamma = self.zero_mul(actv)
+            beta = self.zero_add(actv)
         h = self.param_free_norm(h) * (gamma + 1) + beta
         if h_ori is not None and not self.pre_concat:
             h = th.cat([h_ori, h], dim=1)
+        if not blend:
+            return h
         return h * control_scale + h_raw * (1 - control_scale)
 
 
@@ -130,22 +153,58 @@ class ZeroCrossAttn(nn.Module):
         self.norm2 = normalization(context_dim)
 
         self.mask = mask
+        # memory bounded attention for large latents, 0 disables:
+        # queries processed in chunks of attn_chunk_size tokens
+        self.attn_chunk_size = 0
+        # attention restricted to non overlapping attn_window_size x attn_window_size windows
+        self.attn_window_size = 0
 
         # if zero_out:
         #     # for p in self.attn.to_out.parameters():
         #     #     p.detach().zero_()
         #     self.attn.to_out = zero_module(self.attn.to_out)
 
+    def attention(self, x, context, key_mask=None):
+        if self.attn_chunk_size <= 0 and key_mask is None:
+            return self.attn(x, context)
+        attn = self.attn
+        q, k, v = attn.to_q(x), attn.to_k(context), attn.to_v(context)
+        q, k, v = map(lambda t: rearrange(t, 'b n (h d) -> b h n d', h=attn.heads), (q, k, v))
+        out = chunked_scaled_dot_product_attention(q, k, v, self.attn_chunk_size, attn_mask=key_mask)
+        return attn.to_out(rearrange(out, 'b h n d -> b n (h d)'))
+
+    def window_attention(self, x, context, layout=torch.contiguous_format):
+        b, c, h, w = x.shape
+        ws = self.attn_window_size
+        pad_h, pad_w = -h % ws, -w % ws
+        key_mask = None
+        if pad_h or pad_w:
+            x = nn.functional.pad(x, (0, pad_w, 0, pad_h))
+            context = nn.functional.pad(context, (0, pad_w, 0, pad_h))
+            # padded positions must not take part as keys
+            valid = torch.zeros((1, 1, h + pad_h, w + pad_w), dtype=torch.bool, device=x.device)
+            valid[:, :, :h, :w] = True
+            key_mask = rearrange(valid, 'o c (nh wh) (nw ww) -> (o nh nw) c 1 (wh ww)', wh=ws, ww=ws).repeat(b, 1, 1, 1)
+        nh = (h + pad_h) // ws
+        x = rearrange(x, 'b c (nh wh) (nw ww) -> (b nh nw) (wh ww) c', wh=ws, ww=ws).contiguous()
+        context = rearrange(context, 'b c (nh wh) (nw ww) -> (b nh nw) (wh ww) c', wh=ws, ww=ws).contiguous()
+        x = self.attention(x, context, key_mask)
+        x = rearrange(x, '(b nh nw) (wh ww) c -> b c (nh wh) (nw ww)', b=b, nh=nh, wh=ws, ww=ws)
+        return x[:, :, :h, :w].contiguous(memory_format=layout)
+
     def forward(self, context, x, control_scale=1):
         assert self.mask is False
         x_in = x
         x = self.norm1(x)
         context = self.norm2(context)
         b, c, h, w = x.shape
-        x = rearrange(x, 'b c h w -> b (h w) c').contiguous()
-        context = rearrange(context, 'b c h w -> b (h w) c').contiguous()
-        x = self.attn(x, context)
-        x = rearrange(x, 'b (h w) c -> b c h w', h=h, w=w).contiguous()
+        if self.attn_window_size > 0 and context.shape[-2:] == x.shape[-2:]:
+            x = self.window_attention(x, context, memory_format(x_in))
+        else:
+            x = rearrange(x, 'b c h w -> b (h w) c').contiguous()
+            context = rearrange(context, 'b c h w -> b (h w) c').contiguous()
+            x = self.attention(x, context)
+            x = rearrange(x, 'b (h w) c -> b c h w', h=h, w=w).contiguous(memory_format=memory_format(x_in))
         if self.mask:
             x = x * torch.zeros_like(x)
         x = x_in + x * control_scale
@@ -497,7 +556,7 @@ class GLVControl(nn.Module):
         self.input_blocks.apply(convert_module_to_f32)
         self.middle_block.apply(convert_module_to_f32)
 
-    def forward(self, x, timesteps, xt, context=None, y=None, **kwargs):
+    def forward(self, x, timesteps, xt, context=None, y=None, t_emb=None, num_blocks=None, **kwargs):
         # with torch.cuda.amp.autocast(enabled=False, dtype=torch.float32):
         #     x = x.to(torch.float32)
         #     timesteps = timesteps.to(torch.float32)
@@ -505,7 +564,7 @@ class GLVControl(nn.Module):
         #     context = context.to(torch.float32)
         #     y = y.to(torch.float32)
         # print(x.dtype)
-        xt, context, y = xt.to(x.dtype), context.to(x.dtype), y.to(x.dtype)
+        xt, context, y = xt.to(x.dtype), cached_cast(context, x.dtype), cached_cast(y, x.dtype)
 
         if self.input_upscale != 1:
             x = nn.functional.interpolate(x, scale_factor=self.input_upscale, mode='bilinear', antialias=True)
@@ -513,20 +572,22 @@ class GLVControl(nn.Module):
             self.num_classes is not None
         ), "must specify y if and only if the model is class-conditional"
         hs = []
-        t_emb = timestep_embedding(timesteps, self.model_channels, repeat_only=False).to(x.dtype)
+        if t_emb is None:
+            t_emb = timestep_embedding(timesteps, self.model_channels, repeat_only=False)
         # import pdb
         # pdb.set_trace()
-        emb = self.time_embed(t_emb)
+        emb = self.time_embed(t_emb.to(x.dtype))
 
         if self.num_classes is not None:
             assert y.shape[0] == xt.shape[0]
-            emb = emb + self.label_emb(y)
+            # y is constant during sampling, its embedding is cached for the whole run
+            emb = emb + cached_call(("label_emb", id(self)), (y,), lambda: self.label_emb(y))
 
         guided_hint = self.input_hint_block(x, emb, context)
 
         # h = x.type(self.dtype)
         h = xt
-        for module in self.input_blocks:
+        for module in self.input_blocks[:num_blocks]:
             if guided_hint is not None:
                 h = module(h, emb, context)
                 h += guided_hint
@@ -536,6 +597,9 @@ class GLVControl(nn.Module):
             hs.append(h)
             # print(module)
             # print(h.shape)
+        if num_blocks is not None:
+            # only the shallow features are needed on the feature cached steps of LightGLVUNet
+            return hs
         h = self.middle_block(h, emb, context)
         hs.append(h)
         return hs
@@ -581,6 +645,36 @@ class LightGLVUNet(UNetModel):
             self.project_modules.insert(i, ZeroCrossAttn(cond_output_channels[i], concat_channels[i]))
             # print(self.project_modules[i])
 
+        # DeepCache style feature caching, a full forward every deep_cache_interval steps, in between
+        # only the first/last deep_cache_depth input/output blocks run on top of the cached decoder features
+        self.deep_cache_interval = 1
+        self.deep_cache_depth = 3
+
+    def set_project_attention(self, chunk_size=0, window_size=0):
+        """Sets the memory bounded attention of the ZeroCrossAttn projections, see ZeroCrossAttn"""
+        for module in self.project_modules:
+            if isinstance(module, ZeroCrossAttn):
+                module.attn_chunk_size = chunk_size
+                module.attn_window_size = window_size
+
+    def fuse_project_modules(self):
+        """Fuses the ZeroSFT projections for inference, see ZeroSFT.fuse"""
+        for module in self.project_modules:
+            if isinstance(module, ZeroSFT):
+                module.fuse()
+
+    def deep_cache_lookup(self, context):
+        """
+        Returns the feature cache of this conditioning and whether this step can use it.
+        Needs the run-scoped conditioning cache, otherwise every step is a full step.
+        The cached features are only used on the steps directly following a full step, see cached_step_state.
+        The tiled samplers keep one feature cache per tile batch, so it holds the decoder features of every
+        tile batch for the run.
+        """
+        if self.deep_cache_interval <= 1:
+            return None, False
+        return cached_step_state(("deep_cache", id(self), sampling_tile()), (context,), self.deep_cache_interval, "h")
+
     def step_progressive_mask(self):
         if len(self.progressive_mask_nums) > 0:
             mask_num = self.progressive_mask_nums.pop()
@@ -598,7 +692,8 @@ class LightGLVUNet(UNetModel):
         #     print(self.project_modules[i].mask)
 
 
-    def forward(self, x, timesteps=None, context=None, y=None, control=None, control_scale=1, **kwargs):
+    def forward(self, x, timesteps=None, context=None, y=None, control=None, control_scale=1, t_emb=None,
+                deep_cache=None, use_deep_cache=False, **kwargs):
         """
         Apply the model to an input batch.
         :param x: an [N x C x ...] Tensor of inputs.
@@ -613,30 +708,41 @@ class LightGLVUNet(UNetModel):
         hs = []
 
         _dtype = control[0].dtype
-        x, context, y = x.to(_dtype), context.to(_dtype), y.to(_dtype)
+        x, context, y = x.to(_dtype), cached_cast(context, _dtype), cached_cast(y, _dtype)
 
         with torch.no_grad():
-            t_emb = timestep_embedding(timesteps, self.model_channels, repeat_only=False).to(x.dtype)
-            emb = self.time_embed(t_emb)
+            if t_emb is None:
+                t_emb = timestep_embedding(timesteps, self.model_channels, repeat_only=False)
+            emb = self.time_embed(t_emb.to(x.dtype))
 
             if self.num_classes is not None:
                 assert y.shape[0] == x.shape[0]
-                emb = emb + self.label_emb(y)
+                emb = emb + cached_call(("label_emb", id(self)), (y,), lambda: self.label_emb(y))
 
             # h = x.type(self.dtype)
             h = x
-            for module in self.input_blocks:
+            for module in self.input_blocks[:self.deep_cache_depth if use_deep_cache else None]:
                 h = module(h, emb, context)
                 hs.append(h)
 
-        adapter_idx = len(self.project_modules) - 1
-        control_idx = len(control) - 1
-        h = self.middle_block(h, emb, context)
-        h = self.project_modules[adapter_idx](control[control_idx], h, control_scale=control_scale)
-        adapter_idx -= 1
-        control_idx -= 1
+        cache_idx = len(self.output_blocks) - self.deep_cache_depth
+        if use_deep_cache:
+            # continue from the decoder features of the last full step, control only has the shallow features
+            h, adapter_idx = deep_cache["h"], deep_cache["adapter_idx"]
+            control_idx = len(control) - 1
+            start_idx = cache_idx
+        else:
+            adapter_idx = len(self.project_modules) - 1
+            control_idx = len(control) - 1
+            h = self.middle_block(h, emb, context)
+            h = self.project_modules[adapter_idx](control[control_idx], h, control_scale=control_scale)
+            adapter_idx -= 1
+            control_idx -= 1
+            start_idx = 0
 
-        for i, module in enumerate(self.output_blocks):
+        for i, module in enumerate(self.output_blocks[start_idx:], start_idx):
+            if deep_cache is not None and not use_deep_cache and i == cache_idx:
+                deep_cache["h"], deep_cache["adapter_idx"] = h, adapter_idx
             _h = hs.pop()
             h = self.project_modules[adapter_idx](control[control_idx], _h, h, control_scale=control_scale)
             adapter_idx -= 1
@@ -0,0 +1,180 @@
+'''
+# --------------------------------------------------------------------------------
+#   Weight-only quantization of the Linear and Conv layers of the UNet, control model and VAE.
+#   The weights are stored quantized and dequantized to the compute dtype layer by layer,
+#   the activations stay in the diffusion dtype.
+# --------------------------------------------------------------------------------
+'''
+
+import copy
+import re
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+QUANTIZATION_MODES = ["disabled", "int8", "fp8"]
+# the SUPIR adapters (ZeroSFT/ZeroCrossAttn) are kept at full precision by default
+DEFAULT_SKIP = "project_modules"
+
+TINY = torch.finfo(torch.float32).tiny
+
+
+def quantize_int8(weight):
+    """
+    Symmetric int8 quantization with one scale per output channel.
+    Returns the int8 weight and the float32 scale, shaped to broadcast against it.
+    """
+    w = weight.detach().float()
+    scale = w.abs().amax(dim=tuple(range(1, w.ndim)), keepdim=True) / 127
+    # zero initialized layers (zero_module) have an all zero weight
+    scale = scale.clamp_(min=TINY)
+    q = torch.round(w / scale).clamp_(-127, 127).to(torch.int8)
+    return q, scale
+
+
+def quantize_fp8(weight):
+    """
+    float8_e4m3fn quantization with one scale per tensor, mapping the largest weight to the
+    largest finite fp8 value. Returns the fp8 weight and the float32 scale.
+    """
+    if not hasattr(torch, "float8_e4m3fn"):
+        raise RuntimeError("fp8 weights need PyTorch 2.1 or newer")
+    w = weight.detach().float()
+    fp8_max = torch.finfo(torch.float8_e4m3fn).max
+    scale = (w.abs().amax() / fp8_max).clamp_(min=TINY).reshape((1,) * w.ndim)
+    q = (w / scale).clamp_(-fp8_max, fp8_max).to(torch.float8_e4m3fn)
+    return q, scale
+
+
+QUANTIZERS = {"int8": quantize_int8, "fp8": quantize_fp8}
+
+
+def compute_dtype(x):
+    if torch.is_autocast_enabled() and x.is_cuda:
+        return torch.get_autocast_gpu_dtype()
+    return x.dtype
+
+
+class QuantizedWeight(nn.Module):
+    """
+    Base of the quantized layers. The quantized weight and its float32 scale are stored as integer
+    buffers (fp8 as uint8, the scale as int32 views), so that .to(dtype) on the model only casts
+    the biases, and the full precision weight only exists for the duration of the layer call.
+    """
+
+    def __init__(self, layer, mode="int8"):
+        super().__init__()
+        weight, scale = QUANTIZERS[mode](layer.weight)
+        self.weight_dtype = weight.dtype
+        self.register_buffer("weight", weight.view(torch.uint8) if weight.is_floating_point() else weight)
+        self.register_buffer("weight_scale", scale.view(torch.int32))
+        if layer.bias is not None:
+            self.bias = nn.Parameter(layer.bias.detach(), requires_grad=False)
+        else:
+            self.bias = None
+        # relative error of the dequantized weight against the source weight
+        reference = layer.weight.detach().float()
+        self.quantization_error = ((self.dequantize(torch.float32) - reference).norm() /
+                                   reference.norm().clamp(min=TINY)).item()
+
+    def dequantize(self, dtype):
+        weight = self.weight.view(self.weight_dtype)
+        scale = self.weight_scale.view(torch.float32)
+        # the scales are often below the normal range of fp16, multiply in float32 instead
+        scale_dtype = torch.float32 if dtype == torch.float16 else dtype
+        return (weight.to(scale_dtype) * scale.to(scale_dtype)).to(dtype)
+
+    def cast_bias(self, dtype):
+        return None if self.bias is None else self.bias.to(dtype)
+
+
+class QuantizedLinear(QuantizedWeight):
+    def __init__(self, linear, mode="int8"):
+        super().__init__(linear, mode)
+        self.in_features = linear.in_features
+        self.out_features = linear.out_features
+
+    def forward(self, x):
+        dtype = compute_dtype(x)
+        return F.linear(x, self.dequantize(dtype), self.cast_bias(dtype))
+
+
+class QuantizedConv(QuantizedWeight):
+    CONV_FUNCTIONS = {1: F.conv1d, 2: F.conv2d, 3: F.conv3d}
+
+    def __init__(self, conv, mode="int8"):
+        super().__init__(conv, mode)
+        self.in_channels = conv.in_channels
+        self.out_channels = conv.out_channels
+        self.kernel_size = conv.kernel_size
+        self.stride = conv.stride
+        self.padding = conv.padding
+        self.dilation = conv.dilation
+        self.groups = conv.groups
+        self.conv_function = self.CONV_FUNCTIONS[len(conv.kernel_size)]
+
+    def forward(self, x):
+        dtype = compute_dtype(x)
+        return self.conv_function(x, self.dequantize(dtype), self.cast_bias(dtype),
+                                  self.stride, self.padding, self.dilation, self.groups)
+
+
+def quantize_layer(layer, mode="int8"):
+    """Returns the quantized version of a Linear or Conv layer, or None if it isn't supported"""
+    if isinstance(layer, nn.Linear):
+        return QuantizedLinear(layer, mode)
+    if isinstance(layer, (nn.Conv1d, nn.Conv2d, nn.Conv3d)) and layer.padding_mode == "zeros":
+        return QuantizedConv(layer, mode)
+    return None
+
+
+def quantize_weights(model, mode="int8", skip=()):
+    """
+    Replaces the Linear and Conv layers of model with weight-only quantized ones, in place.
+    skip is a list of regular expressions searched in the qualified module names, matching
+    modules and everything below them are kept at full precision.
+    Call after the weights are loaded and the modules are fused.
+    Returns the number of quantized layers.
+    """
+    if mode == "disabled":
+        return 0
+    if mode not in QUANTIZERS:
+        raise ValueError(f"unsupported quantization mode: {mode}")
+    patterns = [re.compile(p) for p in skip]
+    count = 0
+    for name, module in list(model.named_modules()):
+        for child_name, child in list(module.named_children()):
+            qualified_name = f"{name}.{child_name}" if name else child_name
+            if any(p.search(qualified_name) for p in patterns):
+                continue
+            quantized = quantize_layer(child, mode)
+            if quantized is None:
+                continue
+            setattr(module, child_name, quantized)
+            count += 1
+    return count
+
+
+def max_quantization_error(model):
+    """Largest relative weight error of the quantized layers of model"""
+    return max((m.quantization_error for m in model.modules() if isinstance(m, QuantizedWeight)), default=0.0)
+
+
+def output_error(layer, x, mode="int8", dtype=torch.float16):
+    """
+    Accuracy check of a quantized layer, runs on CPU. Returns the relative error of its output
+    against the layer with its weights rounded to dtype (the fp16 reference), both computed in float32.
+    """
+    reference = copy.deepcopy(layer).to(dtype)
+    quantized = quantize_layer(reference, mode)
+    reference.float()
+    with torch.no_grad():
+        ref = reference(x.float())
+        out = quantized(x.float())
+    return ((out - ref).norm() / ref.norm().clamp(min=TINY)).item()
+
+
+def parse_skip_patterns(skip):
+    """Splits the comma separated patterns of the loader nodes"""
+    return [p.strip() for p in skip.split(",") if p.strip()]
@@ -83,6 +83,13 @@ else:
 
 sd_flag = True
 
+# largest relative error of a sampled tile normalized by the estimated statistics against the exact statistics
+# aggregated over all tiles, above it fast mode falls back to the exact path. Measured FAST_MODE_GUARD_DEPTH
+# group norms deep, the first group norm alone is close to exact because the downsampled input is matched to
+# the mean and std of the input. See scripts/check_fast_mode.py for the errors on real images.
+FAST_MODE_TOLERANCE = 0.1
+FAST_MODE_GUARD_DEPTH = 4
+
 def get_recommend_encoder_tile_size():
     if torch.cuda.is_available():
         total_memory = torch.cuda.get_device_properties(
@@ -505,13 +512,36 @@ def build_task_queue(net, is_decoder):
     return task_queue
 
 
-def clone_task_queue(task_queue):
+def build_task_plan(net, is_decoder):
+    """
+    Compile the task queue of the encoder or decoder into an immutable plan, executed with a cursor per tile
+    @param net: the VAE decoder or encoder network
+    @param is_decoder: currently building decoder or encoder
+    @return: tuple of (name, callable, slot) tasks, slot is the index of the matching add_res task for
+             store_res tasks, where the residual is kept until it's added back, and None otherwise
+    """
+    task_queue = build_task_queue(net, is_decoder)
+    plan = []
+    for i, task in enumerate(task_queue):
+        slot = None
+        if task[0] == 'store_res':
+            slot = next(j for j in range(i + 1, len(task_queue)) if task_queue[j][0] == 'add_res')
+        plan.append((task[0], task[1], slot))
+    return tuple(plan)
+
+
+def channels_innermost(input):
     """
-    Clone a task queue
-    @param task_queue: the task queue to be cloned
-    @return: the cloned task queue
+    True for channels_last tensors and tiles sliced out of them
     """
-    return [[item for item in task] for task in task_queue]
+    return input.dim() == 4 and input.size(1) > 1 and input.stride(1) == 1
+
+
+def net_memory_format(net):
+    """
+    channels_last if the weights of the net were converted to it, the tiles are run in the layout of the weights
+    """
+    return torch.channels_last if channels_innermost(net.conv_in.weight) else torch.contiguous_format
 
 
 def get_var_mean(input, num_groups, eps=1e-6):
@@ -520,6 +550,11 @@ def get_var_mean(input, num_groups, eps=1e-6):
     """
     b, c = input.size(0), input.size(1)
     channel_in_group = int(c/num_groups)
+    if channels_innermost(input):
+        # group the channels in place instead of copying the channels_last tensor to NCHW
+        input_reshaped = input.permute(0, 2, 3, 1).reshape(b, -1, num_groups, channel_in_group)
+        var, mean = torch.var_mean(input_reshaped, dim=[1, 3], unbiased=False)
+        return var.flatten(), mean.flatten()
     input_reshaped = input.contiguous().view(
         1, int(b * num_groups), channel_in_group, *input.size()[2:])
     var, mean = torch.var_mean(
@@ -543,13 +578,23 @@ def custom_group_norm(input, num_groups, mean, var, weight=None, bias=None, eps=
     """
     b, c = input.size(0), input.size(1)
     channel_in_group = int(c/num_groups)
-    input_reshaped = input.contiguous().view(
-        1, int(b * num_groups), channel_in_group, *input.size()[2:])
+    if mean.numel() != b * num_groups:
+        # tiles batched together share the same statistics
+        repeats = b * num_groups // mean.numel()
+        mean, var = mean.repeat(repeats), var.repeat(repeats)
+    if channels_innermost(input):
+        input_reshaped = input.permute(0, 2, 3, 1).reshape(b, -1, num_groups, channel_in_group)
+        mean = mean.view(b, 1, num_groups, 1).to(input.dtype)
+        rstd = torch.rsqrt(var.view(b, 1, num_groups, 1) + eps).to(input.dtype)
+        out = ((input_reshaped - mean) * rstd).view(b, *input.size()[2:], c).permute(0, 3, 1, 2)
+    else:
+        input_reshaped = input.contiguous().view(
+            1, int(b * num_groups), channel_in_group, *input.size()[2:])
 
-    out = F.batch_norm(input_reshaped, mean, var, weight=None, bias=None,
-                       training=False, momentum=0, eps=eps)
+        out = F.batch_norm(input_reshaped, mean, var, weight=None, bias=None,
+                           training=False, momentum=0, eps=eps)
 
-    out = out.view(b, c, *input.size()[2:])
+        out = out.view(b, c, *input.size()[2:])
 
     # post affine transform
     if weight is not None:
@@ -572,6 +617,16 @@ def crop_valid_region(x, input_bbox, target_bbox, is_decoder):
     margin = [target_bbox[i] - padded_bbox[i] for i in range(4)]
     return x[:, :, margin[2]:x.size(2)+margin[3], margin[0]:x.size(3)+margin[1]]
 
+def write_results(result, pending_writes):
+    """
+    Write the crops copied to the host into the result, waiting for the copies to finish
+    @param pending_writes: list of (output bbox, host crop, wait function), emptied
+    """
+    for bbox, crop, wait in pending_writes:
+        wait()
+        result[:, :, bbox[2]:bbox[3], bbox[0]:bbox[1]] = crop
+    pending_writes.clear()
+
 # ↓↓↓ https://github.com/Kahsolt/stable-diffusion-webui-vae-tile-infer ↓↓↓
 
 
@@ -602,6 +657,76 @@ def perfcount(fn):
 # copy end :)
 
 
+class TileStaging:
+    """
+    Parks tiles and residuals on the host between the group norm phases.
+    On cuda the copies go to pinned memory, non-blocking on a dedicated stream, so that parking
+    a tile and prefetching the next one overlap with the compute. Other devices copy synchronously,
+    on cpu the tensors are kept as they are.
+    """
+
+    def __init__(self, device):
+        self.device = torch.device(device)
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+        # id of the host tensor -> (device tensor, copy event) of the prefetches in flight
+        self.pending = {}
+
+    def park(self, x):
+        """
+        Start copying x to the host, returns the host tensor
+        """
+        # the input latent may still be on the host, VAEHook only moves the net
+        if self.device.type == 'cpu' or x.device.type == 'cpu':
+            return x
+        if self.stream is None:
+            return x.cpu()
+        host = torch.empty_like(x, device='cpu', pin_memory=True)
+        self.stream.wait_stream(torch.cuda.current_stream(self.device))
+        with torch.cuda.stream(self.stream):
+            host.copy_(x, non_blocking=True)
+        # x must not be reused by the compute stream before the copy is done
+        x.record_stream(self.stream)
+        return host
+
+    def download(self, x):
+        """
+        Start copying x to the host, returns the host tensor and a function waiting for the copy to finish
+        """
+        host = self.park(x)
+        if self.stream is None:
+            return host, lambda: None
+        event = torch.cuda.Event()
+        event.record(self.stream)
+        return host, event.synchronize
+
+    def prefetch(self, host):
+        """
+        Start copying a parked tensor back to the device
+        """
+        if self.stream is None or host.device == self.device or id(host) in self.pending:
+            return
+        with torch.cuda.stream(self.stream):
+            x = host.to(self.device, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record(self.stream)
+        self.pending[id(host)] = (x, event)
+
+    def get(self, host):
+        """
+        Returns the parked tensor on the device
+        """
+        if host.device == self.device:
+            return host
+        if self.stream is None:
+            return host.to(self.device)
+        self.prefetch(host)
+        x, event = self.pending.pop(id(host))
+        compute_stream = torch.cuda.current_stream(self.device)
+        compute_stream.wait_event(event)
+        x.record_stream(compute_stream)
+        return x
+
+
 class GroupNormParam:
     def __init__(self):
         self.var_list = []
@@ -610,7 +735,10 @@ class GroupNormParam:
         self.weight = None
         self.bias = None
 
-    def add_tile(self, tile, layer):
+    def add_tile(self, tile, layer, num_tiles=1):
+        """
+        tile can be a batch of num_tiles equally shaped tiles, the statistics are still collected per tile
+        """
         var, mean = get_var_mean(tile, 32)
         # For giant images, the variance can be larger than max float16
         # In this case we create a copy to float32
@@ -621,10 +749,11 @@ class GroupNormParam:
         # if torch.isinf(var).any():
         #    print('var: ', var)
         # ====================================================
-        self.var_list.append(var)
-        self.mean_list.append(mean)
-        self.pixel_list.append(
-            tile.shape[2]*tile.shape[3])
+        for tile_var, tile_mean in zip(var.chunk(num_tiles), mean.chunk(num_tiles)):
+            self.var_list.append(tile_var)
+            self.mean_list.append(tile_mean)
+            self.pixel_list.append(
+                tile.shape[2]*tile.shape[3])
         if hasattr(layer, 'weight'):
             self.weight = layer.weight
             self.bias = layer.bias
@@ -643,7 +772,7 @@ class GroupNormParam:
         mean = torch.vstack(self.mean_list)
         max_value = max(self.pixel_list)
         pixels = torch.tensor(
-            self.pixel_list, dtype=torch.float32, device=device) / max_value
+            self.pixel_list, dtype=torch.float32, device=var.device) / max_value
         sum_pixels = torch.sum(pixels)
         pixels = pixels.unsqueeze(
             1) / sum_pixels
@@ -681,13 +810,21 @@ class GroupNormParam:
 
 
 class VAEHook:
-    def __init__(self, net, tile_size, is_decoder, fast_decoder, fast_encoder, color_fix, to_gpu=False):
+    def __init__(self, net, tile_size, is_decoder, fast_decoder, fast_encoder, color_fix, to_gpu=False, tile_batch_size=1,
+                 fast_tolerance=FAST_MODE_TOLERANCE, host_result=False, result_path=None, uint8_range=None):
         self.net = net                  # encoder | decoder
         self.tile_size = tile_size
+        self.tile_batch_size = tile_batch_size   # max number of equally shaped tiles run as one batch
         self.is_decoder = is_decoder
         self.fast_mode = (fast_encoder and not is_decoder) or (
             fast_decoder and is_decoder)
         self.color_fix = color_fix and not is_decoder
+        self.fast_tolerance = fast_tolerance    # fast mode falls back to the exact path above this sampled error
+        # the finished tiles are written to a host result, memory mapped to result_path if given,
+        # instead of a result on the device, so that the device memory doesn't grow with the output size
+        self.host_result = host_result or result_path is not None
+        self.result_path = result_path
+        self.uint8_range = uint8_range          # (low, high) mapped to 0..255 when writing the result, or None
         self.to_gpu = to_gpu
         self.pad = 11 if is_decoder else 32
 
@@ -699,12 +836,41 @@ class VAEHook:
                 self.net.to(device)
             if max(H, W) <= self.pad * 2 + self.tile_size:
                 print("[Tiled VAE]: the input size is tiny and unnecessary to tile.")
-                return self.net.original_forward(x)
+                out = self.net.original_forward(x.contiguous(memory_format=net_memory_format(self.net)))
+                if not self.host_result and self.uint8_range is None:
+                    return out
+                result = self.allocate_result(out.shape, out.device)
+                result.copy_(self.quantize_result(out))
+                return result
             else:
                 return self.vae_tile_forward(x)
         finally:
             self.net.to(original_device)
 
+    def allocate_result(self, shape, device):
+        """
+        Allocate the result, on the device, on the host or memory mapped to self.result_path
+        """
+        dtype = torch.float32 if self.uint8_range is None else torch.uint8
+        if self.result_path is not None:
+            numel = math.prod(shape)
+            with open(self.result_path, 'wb') as f:
+                f.truncate(numel * torch.empty((), dtype=dtype).element_size())
+            return torch.from_file(self.result_path, shared=True, size=numel, dtype=dtype).view(shape)
+        if self.host_result:
+            return torch.empty(shape, dtype=dtype, device='cpu')
+        return torch.zeros(shape, dtype=dtype, device=device, requires_grad=False)
+
+    def quantize_result(self, x):
+        """
+        Map x from self.uint8_range to uint8, done on the device so that only a quarter of the data is copied
+        """
+        if self.uint8_range is None:
+            return x
+        low, high = self.uint8_range
+        x = (x.float().clamp_(low, high) - low) * (255 / (high - low))
+        return x.round_().to(torch.uint8)
+
     def get_best_tile_size(self, lowerbound, upperbound):
         """
         Get the best tile size for GPU memory
@@ -779,49 +945,128 @@ class VAEHook:
 
         return tile_input_bboxes, tile_output_bboxes
 
+    def group_tiles(self, in_bboxes):
+        """
+        Group the tiles with the same input shape into batches of at most tile_batch_size tiles
+        @param in_bboxes: tile input bboxes
+        @return: list of tile index lists
+        """
+        shapes = {}
+        for i, bbox in enumerate(in_bboxes):
+            shapes.setdefault((bbox[1] - bbox[0], bbox[3] - bbox[2]), []).append(i)
+        groups = []
+        for indices in shapes.values():
+            for k in range(0, len(indices), self.tile_batch_size):
+                groups.append(indices[k:k + self.tile_batch_size])
+        return groups
+
+    def get_task_plan(self):
+        """
+        The task plan of the net, built on the first call and cached on the module
+        """
+        plan = getattr(self.net, 'tile_task_plan', None)
+        if plan is None:
+            plan = build_task_plan(self.net, self.is_decoder)
+            self.net.tile_task_plan = plan
+        return plan
+
     @torch.no_grad()
-    def estimate_group_norm(self, z, task_queue, color_fix):
+    def estimate_group_norm(self, z, plan, color_fix):
+        """
+        Run the plan on z up to the last group norm and replace the group norms with ones using the statistics of z
+        @return: the estimated plan, or None if the estimation failed
+        """
         device = z.device
         tile = z
-        last_id = len(task_queue) - 1
-        while last_id >= 0 and task_queue[last_id][0] != 'pre_norm':
+        plan = list(plan)
+        last_id = len(plan) - 1
+        while last_id >= 0 and plan[last_id][0] != 'pre_norm':
             last_id -= 1
-        if last_id <= 0 or task_queue[last_id][0] != 'pre_norm':
+        if last_id <= 0 or plan[last_id][0] != 'pre_norm':
             raise ValueError('No group norm found in the task queue')
+        residuals = {}
         # estimate until the last group norm
         for i in range(last_id + 1):
-            task = task_queue[i]
-            if task[0] == 'pre_norm':
-                group_norm_func = GroupNormParam.from_tile(tile, task[1])
-                task_queue[i] = ('apply_norm', group_norm_func)
+            name, fn, slot = plan[i]
+            if name == 'pre_norm':
+                group_norm_func = GroupNormParam.from_tile(tile, fn)
+                plan[i] = ('apply_norm', group_norm_func, None)
                 if i == last_id:
-                    return True
+                    return tuple(plan)
                 tile = group_norm_func(tile)
-            elif task[0] == 'store_res':
-                task_id = i + 1
-                while task_id < last_id and task_queue[task_id][0] != 'add_res':
-                    task_id += 1
-                if task_id >= last_id:
+            elif name == 'store_res':
+                if slot >= last_id:
                     continue
-                task_queue[task_id][1] = task[1](tile)
-            elif task[0] == 'add_res':
-                tile += task[1].to(device)
-                task[1] = None
-            elif color_fix and task[0] == 'downsample':
+                residuals[slot] = fn(tile)
+            elif name == 'add_res':
+                tile += residuals.pop(i).to(device)
+            elif color_fix and name == 'downsample':
                 for j in range(i, last_id + 1):
-                    if task_queue[j][0] == 'store_res':
-                        task_queue[j] = ('store_res_cpu', task_queue[j][1])
-                return True
+                    if plan[j][0] == 'store_res':
+                        plan[j] = ('store_res_cpu',) + plan[j][1:]
+                return tuple(plan)
             else:
-                tile = task[1](tile)
-            try:
-                devices.test_for_nans(tile, "vae")
-            except:
+                tile = fn(tile)
+            # same check as devices.test_for_nans, devices.py can't be imported in ComfyUI on macOS
+            if torch.all(torch.isnan(tile)).item():
                 print(f'Nan detected in fast mode estimation. Fast mode disabled.')
-                return False
+                return None
 
         raise IndexError('Should not reach here')
 
+    @torch.no_grad()
+    def fast_mode_error(self, z, plan, estimated_plan, in_bboxes, sample, device, layout):
+        """
+        Accuracy guard of fast mode. Runs all tiles with the exact statistics up to the estimated group norm
+        FAST_MODE_GUARD_DEPTH norms deep, like the first passes of the exact path do, and the sampled tile with
+        the estimated statistics, so that the errors of the estimates add up like they do in the output
+        @return: relative error of the sampled tile at that group norm, estimated against exact statistics
+        """
+        estimated = [i for i, task in enumerate(estimated_plan) if task[0] == 'apply_norm']
+        if len(estimated) == 0:
+            return 0.0
+        target = estimated[min(FAST_MODE_GUARD_DEPTH, len(estimated)) - 1]
+        staging = TileStaging(device)
+
+        def run(tile, tasks, start, end, residuals):
+            for i in range(start, end):
+                name, fn, slot = tasks[i]
+                if name == 'store_res' or name == 'store_res_cpu':
+                    residuals[slot] = staging.park(fn(tile))
+                elif name == 'add_res':
+                    tile += staging.get(residuals.pop(i))
+                else:
+                    tile = fn(tile)
+            return tile
+
+        def get_tile(bbox):
+            return z[:, :, bbox[2]:bbox[3], bbox[0]:bbox[1]].to(device).contiguous(memory_format=layout)
+
+        fast = run(get_tile(in_bboxes[sample]), estimated_plan, 0, target + 1, {}).float()
+
+        tiles = [staging.park(get_tile(bbox)) for bbox in in_bboxes]
+        residuals = [{} for _ in in_bboxes]
+        start = 0
+        group_norm_func = None
+        for norm in [i for i in range(target + 1) if plan[i][0] == 'pre_norm']:
+            group_norm_param = GroupNormParam()
+            for j in range(len(tiles)):
+                tile = staging.get(tiles[j])
+                if group_norm_func is not None:
+                    tile = group_norm_func(tile)
+                tile = run(tile, plan, start, norm, residuals[j])
+                group_norm_param.add_tile(tile, plan[norm][1])
+                if norm < target:
+                    tiles[j] = staging.park(tile)
+                else:
+                    # only the sampled tile is normalized with the statistics of the last pass
+                    tiles[j] = tile if j == sample else None
+                del tile
+            group_norm_func = group_norm_param.summary()
+            start = norm + 1
+        exact = group_norm_func(tiles[sample]).float()
+        return ((fast - exact).norm() / exact.norm().clamp(min=1e-6)).item()
+
     @perfcount
     @torch.no_grad()
     def vae_tile_forward(self, z):
@@ -845,19 +1090,27 @@ class VAEHook:
         print(f'[Tiled VAE]: input_size: {z.shape}, tile_size: {tile_size}, padding: {self.pad}')
 
         in_bboxes, out_bboxes = self.split_tiles(height, width)
+        groups = self.group_tiles(in_bboxes)
+        staging = TileStaging(device)
+        # tiles follow the layout of the weights, the parked host copies keep it
+        layout = net_memory_format(net)
 
-        # Prepare tiles by split the input latents
+        # Prepare tiles by split the input latents, the tiles of a group are concatenated along the batch
         tiles = []
-        for input_bbox in in_bboxes:
-            tile = z[:, :, input_bbox[2]:input_bbox[3], input_bbox[0]:input_bbox[1]].cpu()
-            tiles.append(tile)
+        for group in groups:
+            tile = torch.cat([z[:, :, in_bboxes[i][2]:in_bboxes[i][3], in_bboxes[i][0]:in_bboxes[i][1]] for i in group])
+            tiles.append(staging.park(tile.contiguous(memory_format=layout)))
 
         num_tiles = len(tiles)
         num_completed = 0
-
-        # Build task queues
-        single_task_queue = build_task_queue(net, is_decoder)
-        #print(single_task_queue)
+        if num_tiles < len(in_bboxes):
+            print(f'[Tiled VAE]: running {len(in_bboxes)} tiles in {num_tiles} batches')
+
+        # The task plan, tiles keep a cursor into it and their residuals by slot
+        plan = self.get_task_plan()
+        # with the estimated plan tiles run through without waiting at the group norms, so their residuals
+        # stay on the device, except the store_res_cpu ones that cross the exact passes left after color_fix
+        use_estimated = False
         if self.fast_mode:
             # Fast mode: downsample the input image to the tile size,
             # then estimate the group norm parameters on the downsampled image
@@ -875,16 +1128,27 @@ class VAEHook:
             del std_old, mean_old, std_new, mean_new
             # occasionally the std_new is too small or too large, which exceeds the range of float16
             # so we need to clamp it to max z's range.
-            downsampled_z = torch.clamp_(downsampled_z, min=z.min(), max=z.max())
-            estimate_task_queue = clone_task_queue(single_task_queue)
-            if self.estimate_group_norm(downsampled_z, estimate_task_queue, color_fix=self.color_fix):
-                single_task_queue = estimate_task_queue
+            downsampled_z = torch.clamp_(downsampled_z, min=z.min(), max=z.max()).contiguous(memory_format=layout)
+            estimated_plan = self.estimate_group_norm(downsampled_z, plan, color_fix=self.color_fix)
             del downsampled_z
+            if estimated_plan is not None:
+                # sample the center tile, the estimation can be far off for images with very uneven content
+                error = self.fast_mode_error(z, plan, estimated_plan, in_bboxes, len(in_bboxes) // 2, device, layout)
+                if error > self.fast_tolerance:
+                    print(f'[Tiled VAE]: Fast mode error {error:.4f} exceeds {self.fast_tolerance}, falling back to exact group norms')
+                else:
+                    plan = estimated_plan
+                    use_estimated = True
 
-        task_queues = [clone_task_queue(single_task_queue) for _ in range(num_tiles)]
+        num_tasks = len(plan)
+        # index of the group norm a tile starting at a cursor stops at, only the residuals added back before it are prefetched
+        segment_ends = [next((j for j in range(c + 1, num_tasks) if plan[j][0] == 'pre_norm'), num_tasks) for c in range(num_tasks)]
+        cursors = [0] * num_tiles
+        residuals = [{} for _ in range(num_tiles)]
 
         # Dummy result
         result = None
+        pending_writes = []     # tile crops still being copied to the host result
         result_approx = None
         #try:
         #    with devices.autocast():
@@ -894,50 +1158,65 @@ class VAEHook:
         del z
 
         # Task queue execution
-        pbar = tqdm(total=num_tiles * len(task_queues[0]), desc=f"[Tiled VAE]: Executing {'Decoder' if is_decoder else 'Encoder'} Task Queue: ")
-        pbar_comfy = comfy.utils.ProgressBar(num_tiles * len(task_queues[0]))
+        pbar = tqdm(total=num_tiles * num_tasks, desc=f"[Tiled VAE]: Executing {'Decoder' if is_decoder else 'Encoder'} Task Queue: ")
+        pbar_comfy = comfy.utils.ProgressBar(num_tiles * num_tasks)
         # execute the task back and forth when switch tiles so that we always
         # keep one tile on the GPU to reduce unnecessary data transfer
         forward = True
         interrupted = False
+        group_norm_func = None
         #state.interrupted = interrupted
         while True:
             #if state.interrupted: interrupted = True ; break
 
             group_norm_param = GroupNormParam()
-            for i in range(num_tiles) if forward else reversed(range(num_tiles)):
+            order = list(range(num_tiles)) if forward else list(reversed(range(num_tiles)))
+            for k, i in enumerate(order):
                 #if state.interrupted: interrupted = True ; break
 
-                tile = tiles[i].to(device)
-                input_bbox = in_bboxes[i]
-                task_queue = task_queues[i]
+                tile = staging.get(tiles[i])
+                group = groups[i]
+                cursor = cursors[i]
+                tile_residuals = residuals[i]
+                # copy the next tile and its residuals back while this one computes
+                if k + 1 < len(order) and tiles[order[k + 1]] is not None:
+                    next_i = order[k + 1]
+                    staging.prefetch(tiles[next_i])
+                    for slot, res in residuals[next_i].items():
+                        if slot < segment_ends[cursors[next_i]]:
+                            staging.prefetch(res)
+
+                # the tile waits at the group norm whose statistics were collected in the last pass
+                if group_norm_func is not None and plan[cursor][0] == 'pre_norm':
+                    tile = group_norm_func(tile)
+                    cursor += 1
+                    pbar.update(1)
+                    pbar_comfy.update(1)
 
                 interrupted = False
-                while len(task_queue) > 0:
+                while cursor < num_tasks:
                     #if state.interrupted: interrupted = True ; break
 
                     # DEBUG: current task
-                    # print('Running task: ', task_queue[0][0], ' on tile ', i, '/', num_tiles, ' with shape ', tile.shape)
-                    task = task_queue.pop(0)
-                    if task[0] == 'pre_norm':
-                        group_norm_param.add_tile(tile, task[1])
+                    # print('Running task: ', plan[cursor][0], ' on tile ', i, '/', num_tiles, ' with shape ', tile.shape)
+                    name, fn, slot = plan[cursor]
+                    if name == 'pre_norm':
+                        group_norm_param.add_tile(tile, fn, len(group))
                         break
-                    elif task[0] == 'store_res' or task[0] == 'store_res_cpu':
-                        task_id = 0
-                        res = task[1](tile)
-                        if not self.fast_mode or task[0] == 'store_res_cpu':
-                            res = res.cpu()
-                        while task_queue[task_id][0] != 'add_res':
-                            task_id += 1
-                        task_queue[task_id][1] = res
-                    elif task[0] == 'add_res':
-                        tile += task[1].to(device)
-                        task[1] = None
+                    elif name == 'store_res' or name == 'store_res_cpu':
+                        res = fn(tile)
+                        if not use_estimated or name == 'store_res_cpu':
+                            res = staging.park(res)
+                        tile_residuals[slot] = res
+                    elif name == 'add_res':
+                        tile += staging.get(tile_residuals.pop(cursor))
                     else:
-                        tile = task[1](tile)
-                        #print(tiles[i].shape, tile.shape, task)
+                        tile = fn(tile)
+                        #print(tiles[i].shape, tile.shape, name)
+                    cursor += 1
                     pbar.update(1)
                     pbar_comfy.update(1)
+                cursors[i] = cursor
 
                 if interrupted: break
 
@@ -946,12 +1225,19 @@ class VAEHook:
                 #devices.test_for_nans(tile, "vae")
 
                 #print(tiles[i].shape, tile.shape, i, num_tiles)
-                if len(task_queue) == 0:
+                if cursor == num_tasks:
                     tiles[i] = None
                     num_completed += 1
                     if result is None:      # NOTE: dim C varies from different cases, can only be inited dynamically
-                        result = torch.zeros((N, tile.shape[1], height * 8 if is_decoder else height // 8, width * 8 if is_decoder else width // 8), device=device, requires_grad=False)
-                    result[:, :, out_bboxes[i][2]:out_bboxes[i][3], out_bboxes[i][0]:out_bboxes[i][1]] = crop_valid_region(tile, in_bboxes[i], out_bboxes[i], is_decoder)
+                        result = self.allocate_result((N, tile.shape[1], height * 8 if is_decoder else height // 8, width * 8 if is_decoder else width // 8), device)
+                    # write the crops of the previous tile, their copies ran while this tile computed
+                    write_results(result, pending_writes)
+                    for j, single_tile in zip(group, tile.chunk(len(group))):
+                        crop = self.quantize_result(crop_valid_region(single_tile, in_bboxes[j], out_bboxes[j], is_decoder))
+                        if self.host_result:
+                            pending_writes.append((out_bboxes[j],) + staging.download(crop))
+                        else:
+                            result[:, :, out_bboxes[j][2]:out_bboxes[j][3], out_bboxes[j][0]:out_bboxes[j][1]] = crop
                     del tile
                 elif i == num_tiles - 1 and forward:
                     forward = False
@@ -960,19 +1246,19 @@ class VAEHook:
                     forward = True
                     tiles[i] = tile
                 else:
-                    tiles[i] = tile.cpu()
+                    tiles[i] = staging.park(tile)
                     del tile
 
             if interrupted: break
             if num_completed == num_tiles: break
 
-            # insert the group norm task to the head of each task queue
+            # the group norm applied at the start of the next pass
             group_norm_func = group_norm_param.summary()
-            if group_norm_func is not None:
-                for i in range(num_tiles):
-                    task_queue = task_queues[i]
-                    task_queue.insert(0, ('apply_norm', group_norm_func))
 
         # Done!
         pbar.close()
+        if result is not None:
+            write_results(result, pending_writes)
+            if self.host_result or self.uint8_range is not None:
+                return result
         return result.to(dtype) if result is not None else result_approx.to(device)
\ No newline at end of file
@@ -10,6 +10,7 @@ from nodes import ImageScale
 import torch.cuda
 from .sgm.util import instantiate_from_config
 from .SUPIR.util import convert_dtype, load_state_dict
+from .SUPIR.utils.quantize import DEFAULT_SKIP, quantize_weights
 import open_clip
 from contextlib import contextmanager
 
@@ -289,11 +290,11 @@ class SUPIR_Upscale:
 
             self.model.to(dtype)
 
-            #only unets and/or vae to fp8 
+            #only unets and/or vae to fp8, stored with per tensor scales and upcast layer by layer
             if fp8_unet:
-                self.model.model.to(torch.float8_e4m3fn)
+                quantize_weights(self.model.model, "fp8", skip=[DEFAULT_SKIP])
             if fp8_vae:
-                self.model.first_stage_model.to(torch.float8_e4m3fn)
+                quantize_weights(self.model.first_stage_model, "fp8")
 
             if use_tiled_vae:
                 self.model.init_tile_vae(encoder_tile_size=encoder_tile_size_pixels, decoder_tile_size=decoder_tile_size_latent)
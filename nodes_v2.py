@@ -1,4 +1,5 @@
 import os
+import tempfile
 import torch
 from omegaconf import OmegaConf
 import comfy.utils
@@ -9,6 +10,11 @@ import torch.nn.functional as F
 from .sgm.util import instantiate_from_config
 from .SUPIR.util import convert_dtype, load_state_dict
 from .sgm.modules.distributions.distributions import DiagonalGaussianDistribution
+from .sgm.modules.attention import context_kv_cache
+from .sgm.modules.diffusionmodules.util import set_inference_mode, inference_mode_enabled
+from .sgm.modules.diffusionmodules.sampling import stack_conds
+from .SUPIR.utils.quantize import QUANTIZATION_MODES, DEFAULT_SKIP, quantize_weights, max_quantization_error, \
+    parse_skip_patterns
 import open_clip
 from contextlib import contextmanager, nullcontext
 import gc
@@ -100,6 +106,11 @@ class SUPIR_encode:
                     ], {
                         "default": 'auto'
                     }),
+            },
+            "optional": {
+                "tile_batch_size": ("INT", {"default": 1, "min": 1, "max": 64, "step": 1}),
+                "fast_encoder": ("BOOLEAN", {"default": False}),
+                "color_fix": ("BOOLEAN", {"default": False}),
             }
         }
 
@@ -108,7 +119,8 @@ class SUPIR_encode:
     FUNCTION = "encode"
     CATEGORY = "SUPIR"
 
-    def encode(self, SUPIR_VAE, image, encoder_dtype, use_tiled_vae, encoder_tile_size):
+    def encode(self, SUPIR_VAE, image, encoder_dtype, use_tiled_vae, encoder_tile_size, tile_batch_size=1,
+               fast_encoder=False, color_fix=False):
         device = mm.get_torch_device()
         mm.unload_all_models()
         if encoder_dtype == 'auto':
@@ -146,7 +158,7 @@ class SUPIR_encode:
                 SUPIR_VAE.encoder.original_forward = SUPIR_VAE.encoder.forward
             SUPIR_VAE.encoder.forward = VAEHook(
                 SUPIR_VAE.encoder, encoder_tile_size, is_decoder=False, fast_decoder=False,
-                fast_encoder=False, color_fix=False, to_gpu=True)
+                fast_encoder=fast_encoder, color_fix=color_fix, to_gpu=True, tile_batch_size=tile_batch_size)
         else:
             # Only assign `original_forward` back if it exists
             if hasattr(SUPIR_VAE.encoder, 'original_forward'):
@@ -180,6 +192,13 @@ class SUPIR_decode:
             "latents": ("LATENT",),
             "use_tiled_vae": ("BOOLEAN", {"default": True}),
             "decoder_tile_size": ("INT", {"default": 512, "min": 64, "max": 8192, "step": 64}),
+            },
+            "optional": {
+                "tile_batch_size": ("INT", {"default": 1, "min": 1, "max": 64, "step": 1}),
+                "fast_decoder": ("BOOLEAN", {"default": False}),
+                "host_output": ("BOOLEAN", {"default": False}),
+                "uint8_output": ("BOOLEAN", {"default": False}),
+                "mmap_output": ("BOOLEAN", {"default": False}),
             }
         }
 
@@ -187,8 +206,19 @@ class SUPIR_decode:
     RETURN_NAMES = ("image",)
     FUNCTION = "decode"
     CATEGORY = "SUPIR"
+    DESCRIPTION = """
+Decodes the latents with the SUPIR VAE.  
+The following only apply to the tiled VAE:  
+host_output: the decoded tiles are assembled in system memory instead of VRAM,  
+the VRAM use then only depends on the tile size and not on the image size.  
+uint8_output: the tiles are quantized to 8 bit on the GPU while decoding,  
+a quarter of the data is copied and kept until the final conversion.  
+mmap_output: the decoded image is assembled in a memory mapped file in the ComfyUI temp directory  
+instead of system memory, the file is removed once the image is copied out of it.
+"""
 
-    def decode(self, SUPIR_VAE, latents, use_tiled_vae, decoder_tile_size):
+    def decode(self, SUPIR_VAE, latents, use_tiled_vae, decoder_tile_size, tile_batch_size=1, fast_decoder=False,
+               host_output=False, uint8_output=False, mmap_output=False):
         device = mm.get_torch_device()
         mm.unload_all_models()
         samples = latents["samples"]
@@ -208,28 +238,51 @@ class SUPIR_decode:
             if not hasattr(SUPIR_VAE.decoder, 'original_forward'):
                 SUPIR_VAE.decoder.original_forward = SUPIR_VAE.decoder.forward
             SUPIR_VAE.decoder.forward = VAEHook(
-                SUPIR_VAE.decoder, decoder_tile_size // 8, is_decoder=True, fast_decoder=False,
-                fast_encoder=False, color_fix=False, to_gpu=True)
+                SUPIR_VAE.decoder, decoder_tile_size // 8, is_decoder=True, fast_decoder=fast_decoder,
+                fast_encoder=False, color_fix=False, to_gpu=True, tile_batch_size=tile_batch_size,
+                host_result=host_output, uint8_range=(0, 1) if uint8_output else None)
         else:
             # Only assign `original_forward` back if it exists
             if hasattr(SUPIR_VAE.decoder, 'original_forward'):
                 SUPIR_VAE.decoder.forward = SUPIR_VAE.decoder.original_forward
 
         out = []
-        for sample in samples:
-            autocast_condition = (dtype != torch.float32) and not comfy.model_management.is_device_mps(device)
-            with torch.autocast(comfy.model_management.get_autocast_device(device), dtype=dtype) if autocast_condition else nullcontext():
-                sample = 1.0 / 0.13025 * sample
-                decoded_image = SUPIR_VAE.decode(sample.unsqueeze(0)).float()
-                out.append(decoded_image)
-                pbar.update(1)
-
-        decoded_out= torch.cat(out, dim=0)
-        if decoded_out.shape[2] != orig_H or decoded_out.shape[3] != orig_W:
-            print("Restoring original dimensions: ", orig_W,"x",orig_H)
-            decoded_out = F.interpolate(decoded_out, size=(orig_H, orig_W), mode="bicubic")
+        mmap_files = []
+        try:
+            for sample in samples:
+                if use_tiled_vae and mmap_output:
+                    # a new file per sample and run, cached outputs of earlier runs never share it
+                    temp_dir = folder_paths.get_temp_directory()
+                    os.makedirs(temp_dir, exist_ok=True)
+                    fd, mmap_file = tempfile.mkstemp(prefix="supir_decode_", suffix=".bin", dir=temp_dir)
+                    os.close(fd)
+                    mmap_files.append(mmap_file)
+                    SUPIR_VAE.decoder.forward.result_path = mmap_file
+                    SUPIR_VAE.decoder.forward.host_result = True
+                autocast_condition = (dtype != torch.float32) and not comfy.model_management.is_device_mps(device)
+                with torch.autocast(comfy.model_management.get_autocast_device(device), dtype=dtype) if autocast_condition else nullcontext():
+                    sample = 1.0 / 0.13025 * sample
+                    decoded_image = SUPIR_VAE.decode(sample.unsqueeze(0))
+                    # uint8 results are already clipped
+                    decoded_image = decoded_image.float() / 255 if decoded_image.dtype == torch.uint8 else decoded_image.float()
+                    out.append(decoded_image)
+                    pbar.update(1)
 
-        decoded_out = torch.clip(decoded_out, 0, 1)
+            # a single host result is used as it is
+            decoded_out = out[0] if len(out) == 1 else torch.cat(out, dim=0)
+            if decoded_out.shape[2] != orig_H or decoded_out.shape[3] != orig_W:
+                print("Restoring original dimensions: ", orig_W,"x",orig_H)
+                decoded_out = F.interpolate(decoded_out, size=(orig_H, orig_W), mode="bicubic")
+
+            # the memory mapped results are copied, the IMAGE output never references the files
+            decoded_out = torch.clip(decoded_out, 0, 1) if mmap_files else decoded_out.clamp_(0, 1)
+        finally:
+            out = decoded_image = None
+            for mmap_file in mmap_files:
+                try:
+                    os.remove(mmap_file)
+                except OSError as e:
+                    print(f"Could not remove {mmap_file}: {e}")
         decoded_out = decoded_out.cpu().to(torch.float32).permute(0, 2, 3, 1)
         
 
@@ -252,6 +305,12 @@ class SUPIR_first_stage:
                     ], {
                         "default": 'auto'
                     }),
+            },
+            "optional": {
+                "tile_batch_size": ("INT", {"default": 1, "min": 1, "max": 64, "step": 1}),
+                "fast_encoder": ("BOOLEAN", {"default": False}),
+                "fast_decoder": ("BOOLEAN", {"default": False}),
+                "color_fix": ("BOOLEAN", {"default": False}),
             }
         }
 
@@ -263,10 +322,17 @@ class SUPIR_first_stage:
 SUPIR "first stage" processing.
 Encodes and decodes the image using SUPIR's "denoise_encoder", purpose  
 is to fix compression artifacts and such, ends up blurring the image often  
-which is expected. Can be replaced with any other denoiser/blur or not used at all.
+which is expected. Can be replaced with any other denoiser/blur or not used at all.  
+tile_batch_size: number of equally sized VAE tiles encoded/decoded together,  
+faster with many small tiles but uses more VRAM.  
+fast_encoder/fast_decoder: estimate the group norm statistics once on a downsampled image  
+instead of running every tile several times, much faster. A sampled tile is checked against  
+the exact statistics and the exact path is used if the difference is too large.  
+color_fix: with fast_encoder, only estimates up to the first downsample to keep the colors.
 """
 
-    def process(self, SUPIR_VAE, image, encoder_dtype, use_tiled_vae, encoder_tile_size, decoder_tile_size):
+    def process(self, SUPIR_VAE, image, encoder_dtype, use_tiled_vae, encoder_tile_size, decoder_tile_size, tile_batch_size=1,
+                fast_encoder=False, fast_decoder=False, color_fix=False):
         device = mm.get_torch_device()
         mm.unload_all_models()
         if encoder_dtype == 'auto':
@@ -295,11 +361,11 @@ which is expected. Can be replaced with any other denoiser/blur or not used at a
                      
             SUPIR_VAE.denoise_encoder.forward = VAEHook(
                 SUPIR_VAE.denoise_encoder, encoder_tile_size, is_decoder=False, fast_decoder=False,
-                fast_encoder=False, color_fix=False, to_gpu=True)
+                fast_encoder=fast_encoder, color_fix=color_fix, to_gpu=True, tile_batch_size=tile_batch_size)
             
             SUPIR_VAE.decoder.forward = VAEHook(
-                SUPIR_VAE.decoder, decoder_tile_size // 8, is_decoder=True, fast_decoder=False,
-                fast_encoder=False, color_fix=False, to_gpu=True)
+                SUPIR_VAE.decoder, decoder_tile_size // 8, is_decoder=True, fast_decoder=fast_decoder,
+                fast_encoder=False, color_fix=False, to_gpu=True, tile_batch_size=tile_batch_size)
         else:
             # Only assign `original_forward` back if it exists
             if hasattr(SUPIR_VAE.denoise_encoder, 'original_forward'):
@@ -344,6 +410,21 @@ which is expected. Can be replaced with any other denoiser/blur or not used at a
         original_size = [orig_H, orig_W]
         return (SUPIR_VAE, out_stacked, {"samples": out_samples_stacked, "original_size": original_size},)
 
+def _preview_callback(device):
+    """
+    Sampler callback that decodes the denoised latent with ComfyUI's previewer, the sampler
+    sends the returned image as the live preview of its progress bar
+    """
+    import latent_preview
+    import comfy.latent_formats
+    previewer = latent_preview.get_previewer(device, comfy.latent_formats.SDXL())
+    if previewer is None:
+        return None
+
+    def callback(step, denoised, x, total_steps):
+        return previewer.decode_latent_to_preview_image("JPEG", denoised)
+    return callback
+
 class SUPIR_sample:
 
     @classmethod
@@ -377,6 +458,22 @@ class SUPIR_sample:
             "optional": {
                 "sampler_tile_size": ("INT", {"default": 1024, "min": 64, "max": 4096, "step": 32}),
                 "sampler_tile_stride": ("INT", {"default": 512, "min": 32, "max": 2048, "step": 32}),
+                "sampler_tile_batch_size": ("INT", {"default": 1, "min": 1, "max": 64, "step": 1}),
+                "cache_context_kv": ("BOOLEAN", {"default": False}),
+                "sampler_batch_size": ("INT", {"default": 1, "min": 1, "max": 64, "step": 1}),
+                "sequential_cfg": ("BOOLEAN", {"default": False}),
+                "cfg_interval_sigma_min": ("FLOAT", {"default": 0.0, "min": 0.0, "max": 15.0, "step": 0.01}),
+                "cfg_interval_sigma_max": ("FLOAT", {"default": 15.0, "min": 0.0, "max": 15.0, "step": 0.01}),
+                "cfg_skip_threshold": ("FLOAT", {"default": 0.0, "min": 0.0, "max": 10.0, "step": 0.01}),
+                "denoise_strength": ("FLOAT", {"default": 1.0, "min": 0.0, "max": 1.0, "step": 0.01}),
+                "preview_every": ("INT", {"default": 0, "min": 0, "max": 100, "step": 1}),
+                "deep_cache_interval": ("INT", {"default": 1, "min": 1, "max": 10, "step": 1}),
+                "deep_cache_depth": ("INT", {"default": 3, "min": 1, "max": 8, "step": 1}),
+                "control_reuse_interval": ("INT", {"default": 1, "min": 1, "max": 10, "step": 1}),
+                "control_reuse_sigma_max": ("FLOAT", {"default": 15.0, "min": 0.0, "max": 15.0, "step": 0.01}),
+                "control_attn_chunk_size": ("INT", {"default": 0, "min": 0, "max": 65536, "step": 256}),
+                "control_attn_window_size": ("INT", {"default": 0, "min": 0, "max": 256, "step": 8}),
+                "block_offload": ("BOOLEAN", {"default": False}),
             }
         }
 
@@ -415,13 +512,78 @@ DPMPP samplers work well with lower steps, good for lightning models.
 Tiled samplers enable tiled diffusion process, this is very slow but allows higher  
 resolutions to be used by saving VRAM.  Tile size should be chosen so the image  
 is evenly tiled.  Tile stride affects the overlap of the tiles.  Check the  
-SUPIR Tiles -node for preview to understand how the image is tiled.
+SUPIR Tiles -node for preview to understand how the image is tiled.  
+- **sampler_tile_batch_size:**
+Number of tiles the tiled samplers denoise together in one model call.  
+Higher values are faster when the tiles are small, but use more VRAM.  
+- **cache_context_kv:**
+Projects the text conditioning to cross-attention keys/values only once per  
+sampling run instead of on every step, uses a bit of extra VRAM: one set of keys/values  
+per distinct prompt, also with tiled samplers and tiled captions.  
+- **sampler_batch_size:**
+Number of images of the input batch sampled together in one sampler run.  
+Faster for image batches and video frames, but uses more VRAM.  
+Has no effect with tiled captions, those are always sampled one image at a time.  
+- **sequential_cfg:**
+Runs the negative and positive prompt as two separate model passes instead of one  
+pass at double batch size. Roughly halves the peak VRAM use of the sampler, allowing  
+larger images without tiled samplers, at the cost of some speed.  
+- **cfg_interval_sigma_min / cfg_interval_sigma_max:**
+CFG is only applied to steps with a noise level (sigma) inside this range, the  
+other steps only run the positive prompt, which is about twice as fast.  
+The sigmas go from ~14.6 at the first step down to 0.  
+- **cfg_skip_threshold:**
+Steps where the cfg scale is within this distance of 1.0 skip the negative prompt,  
+as it has next to no effect there. Useful when cfg_scale_end is close to 1.0.  
+- **denoise_strength:**
+Below 1.0 the sampling starts from the noised SUPIR latent partway through the  
+schedule instead of from pure noise, skipping that part of the steps.  
+Lower values are faster and stay closer to the input, good for mild restorations.  
+Only used with SUPIR latents.  
+- **preview_every:**
+Shows a live preview of the denoised image every N steps, using the preview method  
+set in ComfyUI (latent2rgb or TAESD). 0 (the default) disables the preview.  
+- **deep_cache_interval:**
+Feature caching, only every Nth step runs the full model, the steps in between  
+reuse the deep features of the last full step and only run the shallow blocks.  
+2 is close to twice as fast with a small loss of detail, 1 disables it.  
+The cached features are kept in VRAM for the whole run, with tiled samplers once per  
+tile batch, about the size of the latent tile at 640 channels (depth 3) per tile.  
+- **deep_cache_depth:**
+Number of shallow blocks that are still computed on the cached steps.  
+Higher values keep more quality but save less time.  
+- **control_reuse_interval:**
+The SUPIR control model only runs every Nth step, the steps in between reuse its  
+last output. Saves close to half of the step cost per skipped step, 1 disables it.  
+The last output is kept in VRAM for the whole run, with tiled samplers once per tile  
+batch, which adds up to several GB for large images with many tiles.  
+- **control_reuse_sigma_max:**
+Control is only reused on steps with a noise level (sigma) below this value,  
+the control scale matters less towards the end of the sampling.  
+- **control_attn_chunk_size:**
+The control cross-attention attends over the whole latent, which is quadratic in  
+image area. Processes it in chunks of this many tokens to bound the memory use,  
+also without xformers and on CPU. Same result, 0 disables chunking.  
+- **control_attn_window_size:**
+Restricts the control cross-attention to local windows of this size (in latent  
+feature pixels), much cheaper at high resolution but changes the result slightly.  
+0 uses the full attention.  
+- **block_offload:**
+Low VRAM mode, the blocks of the unet and control model are kept in system RAM  
+and streamed to the GPU one at a time during sampling, the next block is copied  
+while the current one runs. Allows larger images without tiled samplers on small  
+cards, but is limited by the PCIe bandwidth and slower, especially with tiled samplers.  
 
 """
 
     def sample(self, SUPIR_model, latents, steps, seed, cfg_scale_end, EDM_s_churn, s_noise, positive, negative,
                 cfg_scale_start, control_scale_start, control_scale_end, restore_cfg, keep_model_loaded, DPMPP_eta,
-                sampler, sampler_tile_size=1024, sampler_tile_stride=512):
+                sampler, sampler_tile_size=1024, sampler_tile_stride=512, sampler_tile_batch_size=1,
+                cache_context_kv=False, sampler_batch_size=1, sequential_cfg=False,
+                cfg_interval_sigma_min=0.0, cfg_interval_sigma_max=15.0, cfg_skip_threshold=0.0, denoise_strength=1.0,
+                preview_every=0, deep_cache_interval=1, deep_cache_depth=3, control_reuse_interval=1,
+                control_reuse_sigma_max=15.0, control_attn_chunk_size=0, control_attn_window_size=0,
+                block_offload=False):
         
         torch.manual_seed(seed)
         device = mm.get_torch_device()
@@ -435,6 +597,9 @@ SUPIR Tiles -node for preview to understand how the image is tiled.
                 'restore_cfg': restore_cfg,
                 's_churn': EDM_s_churn,
                 's_noise': s_noise,
+                # external latents are used as they are, there is no noise to partially remove
+                'denoise_strength': denoise_strength if 'original_size' in latents else 1.0,
+                'preview_every': preview_every,
                 'discretization_config': {
                     'target': '.sgm.modules.diffusionmodules.discretizer.LegacyDDPMDiscretization'
                 },
@@ -442,14 +607,22 @@ SUPIR Tiles -node for preview to understand how the image is tiled.
                     'target': '.sgm.modules.diffusionmodules.guiders.LinearCFG',
                     'params': {
                         'scale': cfg_scale_start,
-                        'scale_min': cfg_scale_end
+                        'scale_min': cfg_scale_end,
+                        'sequential': sequential_cfg
                     }
                 }
             }
         }
+        if cfg_interval_sigma_min > 0 or cfg_interval_sigma_max < 15.0 or cfg_skip_threshold > 0:
+            guider_config = self.sampler_config['params']['guider_config']
+            guider_config['target'] = '.sgm.modules.diffusionmodules.guiders.GuidanceIntervalCFG'
+            guider_config['params']['sigma_min'] = cfg_interval_sigma_min
+            guider_config['params']['sigma_max'] = cfg_interval_sigma_max
+            guider_config['params']['scale_threshold'] = cfg_skip_threshold
         if 'Tiled' in sampler:
             self.sampler_config['params']['tile_size'] = sampler_tile_size // 8
             self.sampler_config['params']['tile_stride'] = sampler_tile_stride // 8
+            self.sampler_config['params']['tile_batch_size'] = sampler_tile_batch_size
         if 'DPMPP' in sampler:
             self.sampler_config['params']['eta'] = DPMPP_eta
             self.sampler_config['params']['restore_cfg'] = -1
@@ -460,12 +633,22 @@ SUPIR Tiles -node for preview to understand how the image is tiled.
         print("sampler_config: ", self.sampler_config)
         
         SUPIR_model.denoiser.to(device)
-        SUPIR_model.model.diffusion_model.to(device)
-        SUPIR_model.model.control_model.to(device)
+        if block_offload:
+            SUPIR_model.model.enable_block_offload(device)
+        else:
+            SUPIR_model.model.disable_block_offload()
+            SUPIR_model.model.diffusion_model.to(device)
+            SUPIR_model.model.control_model.to(device)
+        SUPIR_model.model.diffusion_model.deep_cache_interval = deep_cache_interval
+        SUPIR_model.model.diffusion_model.deep_cache_depth = deep_cache_depth
+        SUPIR_model.model.diffusion_model.set_project_attention(control_attn_chunk_size, control_attn_window_size)
+        SUPIR_model.model.control_reuse_interval = control_reuse_interval
+        SUPIR_model.model.control_reuse_max_sigma = control_reuse_sigma_max
         
         use_linear_control_scale = control_scale_start != control_scale_end
 
         denoiser = lambda input, sigma, c, control_scale: SUPIR_model.denoiser(SUPIR_model.model, input, sigma, c, control_scale)
+        callback = _preview_callback(device) if preview_every > 0 else None
 
         original_size = positive['original_size']
         positive = positive['cond']
@@ -476,23 +659,32 @@ SUPIR Tiles -node for preview to understand how the image is tiled.
         #print("negatives: ", len(negative))
         out = []
         pbar = comfy.utils.ProgressBar(samples.shape[0])
-        for i, sample in enumerate(samples):
+        # tiled captions are a list of conds for a single image, those can't be batched
+        tiled_captions = len(positive) != len(samples)
+        batch_size = 1 if tiled_captions else sampler_batch_size
+        for i in range(0, samples.shape[0], batch_size):
+            sample = samples[i:i + batch_size]
             try:
                 if 'original_size' in latents:
                     print("Using random noise")
-                    noised_z = torch.randn_like(sample.unsqueeze(0), device=samples.device)
+                    noised_z = torch.randn_like(sample, device=samples.device)
                 else:
                     print("Using latent from input")
-                    noised_z = sample.unsqueeze(0) * 0.13025
-                if len(positive) != len(samples):
-                    print("Tiled sampling")
-                    _samples = self.sampler(denoiser, noised_z, cond=positive, uc=negative, x_center=sample.unsqueeze(0), control_scale=control_scale_end,
-                                    use_linear_control_scale=use_linear_control_scale, control_scale_start=control_scale_start)
-                else:
-                    #print("positives[i]: ", len(positive[i]))
-                    #print("negatives[i]: ", len(negative[i]))
-                    _samples = self.sampler(denoiser, noised_z, cond=positive[i], uc=negative[i], x_center=sample.unsqueeze(0), control_scale=control_scale_end,
-                                            use_linear_control_scale=use_linear_control_scale, control_scale_start=control_scale_start)
+                    noised_z = sample * 0.13025
+                with context_kv_cache(cache_kv=cache_context_kv), \
+                        (torch.inference_mode() if inference_mode_enabled() else nullcontext()):
+                    if tiled_captions:
+                        print("Tiled sampling")
+                        _samples = self.sampler(denoiser, noised_z, cond=positive, uc=negative, x_center=sample, control_scale=control_scale_end,
+                                        use_linear_control_scale=use_linear_control_scale, control_scale_start=control_scale_start,
+                                        callback=callback)
+                    else:
+                        #print("positives[i]: ", len(positive[i]))
+                        #print("negatives[i]: ", len(negative[i]))
+                        _samples = self.sampler(denoiser, noised_z, cond=stack_conds(positive[i:i + batch_size]), uc=stack_conds(negative[i:i + batch_size]),
+                                                x_center=sample, control_scale=control_scale_end,
+                                                use_linear_control_scale=use_linear_control_scale, control_scale_start=control_scale_start,
+                                                callback=callback)
 
                 
             except torch.cuda.OutOfMemoryError as e:
@@ -503,10 +695,15 @@ SUPIR Tiles -node for preview to understand how the image is tiled.
                       " and it has devoured all of the memory it had reserved, you may need to restart ComfyUI. Make sure you are using tiled_vae, "
                       " you can also try using fp8 for reduced memory usage if your system supports it.")
                 raise e
+            if _samples.is_inference():
+                # inference tensors can't be modified in-place by downstream nodes
+                _samples = _samples.clone()
             out.append(_samples)
-            print("Sampled ", i+1, " of ", samples.shape[0])
-            pbar.update(1)
+            print("Sampled ", i + sample.shape[0], " of ", samples.shape[0])
+            pbar.update(sample.shape[0])
 
+        if block_offload:
+            SUPIR_model.model.block_offload.release_all()
         if not keep_model_loaded:
             SUPIR_model.denoiser.to('cpu')
             SUPIR_model.model.diffusion_model.to('cpu')
@@ -717,10 +914,7 @@ Loads the SUPIR model and the selected SDXL model and merges them.
                 print(f"Attempting to load SDXL model: [{SDXL_MODEL_PATH}]")
                 sdxl_state_dict = load_state_dict(SDXL_MODEL_PATH)
                 self.model.load_state_dict(sdxl_state_dict, strict=False)
-                if fp8_unet:
-                    self.model.model.to(torch.float8_e4m3fn)
-                else:
-                    self.model.model.to(dtype)
+                self.model.model.to(dtype)
                 pbar.update(1)
             except:
                 raise Exception("Failed to load SDXL model")
@@ -766,10 +960,13 @@ Loads the SUPIR model and the selected SDXL model and merges them.
                 print(f'Attempting to load SUPIR model: [{SUPIR_MODEL_PATH}]')
                 supir_state_dict = load_state_dict(SUPIR_MODEL_PATH)
                 self.model.load_state_dict(supir_state_dict, strict=False)
+                self.model.model.diffusion_model.fuse_project_modules()
+                set_inference_mode(True)
                 if fp8_unet:
-                    self.model.model.to(torch.float8_e4m3fn)
-                else:
-                    self.model.model.to(dtype)
+                    count = quantize_weights(self.model.model, "fp8", skip=[DEFAULT_SKIP])
+                    print(f"Quantized {count} layers to fp8, "
+                          f"max relative weight error {max_quantization_error(self.model.model):.4f}")
+                self.model.model.to(dtype)
                 del supir_state_dict
                 pbar.update(1)
             except:
@@ -799,6 +996,9 @@ class SUPIR_model_loader_v2:
             },
             "optional": {
                 "high_vram": ("BOOLEAN", {"default": False}),
+                "weight_quantization": (QUANTIZATION_MODES, {"default": 'disabled'}),
+                "quantization_skip": ("STRING", {"default": DEFAULT_SKIP}),
+                "channels_last": ("BOOLEAN", {"default": False}),
             }
         }
 
@@ -810,11 +1010,19 @@ class SUPIR_model_loader_v2:
 Loads the SUPIR model and merges it with the SDXL model.  
 
 Diffusion type should be kept on auto, unless you have issues loading the model.  
-fp8_unet casts the unet weights to torch.float8_e4m3fn, which saves a lot of VRAM but has slight quality impact.  
-high_vram: uses Accelerate to load weights to GPU, slightly faster model loading.
+fp8_unet stores the unet and control model weights as torch.float8_e4m3fn with per tensor scales, which saves a lot of VRAM,  
+same as weight_quantization fp8.  
+high_vram: uses Accelerate to load weights to GPU, slightly faster model loading.  
+weight_quantization: stores the Linear and Conv weights of the unet and control model quantized and dequantizes them  
+layer by layer, roughly halving their VRAM compared to fp16. int8 uses per channel scales, fp8 per tensor scales. Overrides fp8_unet.  
+quantization_skip: comma separated regular expressions of module names kept at full precision,  
+the default keeps the SUPIR adapters (ZeroSFT/ZeroCrossAttn), 'control_model' would keep the whole control model.  
+channels_last: runs the unet, control model and VAE in the channels_last memory format, which is often faster  
+for convolutions on recent GPUs and on CPU.
 """
 
-    def process(self, supir_model, diffusion_dtype, fp8_unet, model, clip, vae, high_vram=False):
+    def process(self, supir_model, diffusion_dtype, fp8_unet, model, clip, vae, high_vram=False,
+                weight_quantization="disabled", quantization_skip=DEFAULT_SKIP, channels_last=False):
         if high_vram:
             device = mm.get_torch_device()
         else:
@@ -828,10 +1036,16 @@ high_vram: uses Accelerate to load weights to GPU, slightly faster model loading
         clip_config_path = os.path.join(script_directory, "configs/clip_vit_config.json")
         tokenizer_path = os.path.join(script_directory, "configs/tokenizer")
 
+        if weight_quantization == "disabled" and fp8_unet:
+            weight_quantization = "fp8"
+
         custom_config = {
             'diffusion_dtype': diffusion_dtype,
             'supir_model': supir_model,
             'fp8_unet': fp8_unet,
+            'weight_quantization': weight_quantization,
+            'quantization_skip': quantization_skip,
+            'channels_last': channels_last,
             'model': model,
             "clip": clip,
             "vae": vae
@@ -883,10 +1097,7 @@ high_vram: uses Accelerate to load weights to GPU, slightly faster model loading
                         set_module_tensor_to_device(self.model, key, device=device, dtype=dtype, value=sdxl_state_dict[key])
                 else:
                     self.model.load_state_dict(sdxl_state_dict, strict=False)
-                if fp8_unet:
-                    self.model.model.to(torch.float8_e4m3fn)
-                else:
-                    self.model.model.to(dtype)
+                self.model.model.to(dtype)
                 del sdxl_state_dict
                 pbar.update(1)
             except:
@@ -947,10 +1158,17 @@ high_vram: uses Accelerate to load weights to GPU, slightly faster model loading
                         set_module_tensor_to_device(self.model, key, device=device, dtype=dtype, value=supir_state_dict[key])
                 else:
                     self.model.load_state_dict(supir_state_dict, strict=False)
-                if fp8_unet:
-                    self.model.model.to(torch.float8_e4m3fn)
-                else:
-                    self.model.model.to(dtype)
+                self.model.model.diffusion_model.fuse_project_modules()
+                set_inference_mode(True)
+                if weight_quantization != "disabled":
+                    count = quantize_weights(self.model.model, weight_quantization, skip=parse_skip_patterns(quantization_skip))
+                    print(f"Quantized {count} layers to {weight_quantization}, "
+                          f"max relative weight error {max_quantization_error(self.model.model):.4f}")
+                self.model.model.to(dtype)
+                if channels_last:
+                    self.model.model.to(memory_format=torch.channels_last)
+                    self.model.first_stage_model.to(memory_format=torch.channels_last)
+                self.model.model.channels_last = channels_last
                 del supir_state_dict
                 pbar.update(1)
             except:
@@ -981,6 +1199,9 @@ class SUPIR_model_loader_v2_clip:
             },
             "optional": {
                 "high_vram": ("BOOLEAN", {"default": False}),
+                "weight_quantization": (QUANTIZATION_MODES, {"default": 'disabled'}),
+                "quantization_skip": ("STRING", {"default": DEFAULT_SKIP}),
+                "channels_last": ("BOOLEAN", {"default": False}),
             }
         }
 
@@ -992,11 +1213,19 @@ class SUPIR_model_loader_v2_clip:
 Loads the SUPIR model and merges it with the SDXL model.  
 
 Diffusion type should be kept on auto, unless you have issues loading the model.  
-fp8_unet casts the unet weights to torch.float8_e4m3fn, which saves a lot of VRAM but has slight quality impact.  
-high_vram: uses Accelerate to load weights to GPU, slightly faster model loading.
+fp8_unet stores the unet and control model weights as torch.float8_e4m3fn with per tensor scales, which saves a lot of VRAM,  
+same as weight_quantization fp8.  
+high_vram: uses Accelerate to load weights to GPU, slightly faster model loading.  
+weight_quantization: stores the Linear and Conv weights of the unet and control model quantized and dequantizes them  
+layer by layer, roughly halving their VRAM compared to fp16. int8 uses per channel scales, fp8 per tensor scales. Overrides fp8_unet.  
+quantization_skip: comma separated regular expressions of module names kept at full precision,  
+the default keeps the SUPIR adapters (ZeroSFT/ZeroCrossAttn), 'control_model' would keep the whole control model.  
+channels_last: runs the unet, control model and VAE in the channels_last memory format, which is often faster  
+for convolutions on recent GPUs and on CPU.
 """
 
-    def process(self, supir_model, diffusion_dtype, fp8_unet, model, clip_l, clip_g, vae, high_vram=False):
+    def process(self, supir_model, diffusion_dtype, fp8_unet, model, clip_l, clip_g, vae, high_vram=False,
+                weight_quantization="disabled", quantization_skip=DEFAULT_SKIP, channels_last=False):
         if high_vram:
             device = mm.get_torch_device()
         else:
@@ -1010,10 +1239,16 @@ high_vram: uses Accelerate to load weights to GPU, slightly faster model loading
         clip_config_path = os.path.join(script_directory, "configs/clip_vit_config.json")
         tokenizer_path = os.path.join(script_directory, "configs/tokenizer")
 
+        if weight_quantization == "disabled" and fp8_unet:
+            weight_quantization = "fp8"
+
         custom_config = {
             'diffusion_dtype': diffusion_dtype,
             'supir_model': supir_model,
             'fp8_unet': fp8_unet,
+            'weight_quantization': weight_quantization,
+            'quantization_skip': quantization_skip,
+            'channels_last': channels_last,
             'model': model,
             "clip": clip_l,
             "clip_g": clip_g,
@@ -1066,10 +1301,7 @@ high_vram: uses Accelerate to load weights to GPU, slightly faster model loading
                         set_module_tensor_to_device(self.model, key, device=device, dtype=dtype, value=sdxl_state_dict[key])
                 else:
                     self.model.load_state_dict(sdxl_state_dict, strict=False)
-                if fp8_unet:
-                    self.model.model.to(torch.float8_e4m3fn)
-                else:
-                    self.model.model.to(dtype)
+                self.model.model.to(dtype)
                 del sdxl_state_dict
                 pbar.update(1)
             except:
@@ -1136,10 +1368,17 @@ high_vram: uses Accelerate to load weights to GPU, slightly faster model loading
                         set_module_tensor_to_device(self.model, key, device=device, dtype=dtype, value=supir_state_dict[key])
                 else:
                     self.model.load_state_dict(supir_state_dict, strict=False)
-                if fp8_unet:
-                    self.model.model.to(torch.float8_e4m3fn)
-                else:
-                    self.model.model.to(dtype)
+                self.model.model.diffusion_model.fuse_project_modules()
+                set_inference_mode(True)
+                if weight_quantization != "disabled":
+                    count = quantize_weights(self.model.model, weight_quantization, skip=parse_skip_patterns(quantization_skip))
+                    print(f"Quantized {count} layers to {weight_quantization}, "
+                          f"max relative weight error {max_quantization_error(self.model.model):.4f}")
+                self.model.model.to(dtype)
+                if channels_last:
+                    self.model.model.to(memory_format=torch.channels_last)
+                    self.model.first_stage_model.to(memory_format=torch.channels_last)
+                self.model.model.channels_last = channels_last
                 del supir_state_dict
                 pbar.update(1)
             except:
@@ -0,0 +1,67 @@
+'''
+# --------------------------------------------------------------------------------
+#   Shared setup of the benchmark and check scripts: importing the node pack
+#   from a ComfyUI install and building its models from options/SUPIR_v0.yaml.
+# --------------------------------------------------------------------------------
+'''
+
+import importlib
+import os
+import sys
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# the scripts are run from the node pack in ComfyUI/custom_nodes
+COMFYUI_DIR = os.path.dirname(os.path.dirname(PACKAGE_DIR))
+
+
+def add_common_arguments(parser):
+    parser.add_argument("--dtype", choices=["fp16", "bf16", "fp32"], default="fp16")
+    parser.add_argument("--comfyui", default=COMFYUI_DIR)
+
+
+def import_package(comfyui_dir):
+    # the node pack imports comfy and uses its directory name as package name
+    sys.path.insert(0, comfyui_dir)
+    sys.path.insert(0, os.path.dirname(PACKAGE_DIR))
+    return importlib.import_module(os.path.basename(PACKAGE_DIR))
+
+
+def import_module(package, name):
+    """Module of the node pack by its name relative to the package, e.g. SUPIR.utils.tilevae"""
+    return importlib.import_module(package.__name__ + "." + name)
+
+
+def load_config():
+    from omegaconf import OmegaConf
+    return OmegaConf.load(os.path.join(PACKAGE_DIR, "options", "SUPIR_v0.yaml")).model.params
+
+
+def load_weights(package, module, ckpts, prefix):
+    """Loads the weights under prefix of the SDXL / SUPIR checkpoints into module"""
+    for ckpt in ckpts:
+        state_dict = package.SUPIR.util.load_state_dict(ckpt)
+        module.load_state_dict({k[len(prefix):]: v for k, v in state_dict.items() if k.startswith(prefix)}, strict=False)
+
+
+def build_model(package, ckpts, dtype, device):
+    """The UNet and control model in a ControlWrapper, random weights unless checkpoints are given"""
+    instantiate_from_config = package.sgm.util.instantiate_from_config
+    ControlWrapper = package.sgm.modules.diffusionmodules.wrappers.ControlWrapper
+
+    config = load_config()
+    model = ControlWrapper(instantiate_from_config(config.network_config), dtype=dtype)
+    model.load_control_model(instantiate_from_config(config.control_stage_config))
+    load_weights(package, model, ckpts, "model.")
+    return model.to(dtype).to(device).eval()
+
+
+def build_vae(package, ckpts, dtype, device):
+    """
+    The VAE, random weights unless checkpoints are given. The forwards of the encoder and decoder
+    are stored as original_forward, like the nodes do before hooking them with VAEHook.
+    """
+    vae = package.sgm.util.instantiate_from_config(load_config().first_stage_config)
+    load_weights(package, vae, ckpts, "first_stage_model.")
+    vae.encoder.original_forward = vae.encoder.forward
+    vae.decoder.original_forward = vae.decoder.forward
+    return vae.to(dtype).to(device).eval()
@@ -0,0 +1,94 @@
+'''
+# --------------------------------------------------------------------------------
+#   Timing of the channels_last memory format (the channels_last loader option)
+#   against the default contiguous NCHW layout.
+#
+#   Builds the UNet, control model and VAE of options/SUPIR_v0.yaml, converts them to
+#   each layout like the loader does and times a ControlWrapper forward and a tiled VAE
+#   encode and decode through VAEHook. Inputs are passed in NCHW, the conversion of the
+#   inputs and tiles is part of the timing. Random weights are enough for the timing.
+#
+#   Run from the ComfyUI directory:
+#   python custom_nodes/ComfyUI-SUPIR/scripts/benchmark_channels_last.py --size 1024 --dtype fp16
+# --------------------------------------------------------------------------------
+'''
+
+import argparse
+import time
+
+from _common import add_common_arguments, build_model, build_vae, import_module, import_package
+
+
+def hook_vae(package, vae, tile_size):
+    """Tiled encoder and decoder forwards, as set up by the SUPIR encode / decode nodes"""
+    VAEHook = import_module(package, "SUPIR.utils.tilevae").VAEHook
+    encoder = VAEHook(vae.encoder, tile_size, is_decoder=False, fast_decoder=False, fast_encoder=False, color_fix=False)
+    decoder = VAEHook(vae.decoder, tile_size // 8, is_decoder=True, fast_decoder=False, fast_encoder=False, color_fix=False)
+    return encoder, decoder
+
+
+def timed(fn, repeats, device):
+    """Seconds per call of fn, after a warm up call"""
+    import torch
+    with torch.no_grad():
+        fn()
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            fn()
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+    return (time.perf_counter() - start) / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=1024, help="image size in pixels, the latent is 8 times smaller")
+    parser.add_argument("--tile-size", type=int, default=512, help="VAE tile size in pixels")
+    parser.add_argument("--repeats", type=int, default=3)
+    add_common_arguments(parser)
+    args = parser.parse_args()
+
+    package = import_package(args.comfyui)
+    import torch
+    import comfy.model_management
+    device = comfy.model_management.get_torch_device()
+    dtype = package.SUPIR.util.convert_dtype(args.dtype)
+    model = build_model(package, [], dtype, device)
+    vae = build_vae(package, [], dtype, device)
+    encoder, decoder = hook_vae(package, vae, args.tile_size)
+
+    generator = torch.Generator().manual_seed(0)
+    latent = args.size // 8
+    cond = {
+        "crossattn": torch.randn(1, 77, 2048, generator=generator).to(dtype).to(device),
+        "vector": torch.randn(1, 2816, generator=generator).to(dtype).to(device),
+        "control": torch.randn(1, 4, latent, latent, generator=generator).to(dtype).to(device),
+    }
+    x = torch.randn(1, 4, latent, latent, generator=generator).to(dtype).to(device)
+    t = torch.full((1,), 500.0, device=device)
+    image = torch.randn(1, 3, args.size, args.size, generator=generator).to(dtype).to(device)
+
+    benchmarks = {
+        "unet + control": lambda: model(x, t, cond),
+        "tiled VAE encode": lambda: encoder(image),
+        "tiled VAE decode": lambda: decoder(x),
+    }
+    results = {}
+    for name, layout in (("NCHW", torch.contiguous_format), ("channels_last", torch.channels_last)):
+        # converted like the loader does with the channels_last option
+        model.to(memory_format=layout)
+        vae.to(memory_format=layout)
+        model.channels_last = layout == torch.channels_last
+        for benchmark, fn in benchmarks.items():
+            results[benchmark, name] = timed(fn, args.repeats, device)
+
+    for benchmark in benchmarks:
+        nchw, channels_last = results[benchmark, "NCHW"], results[benchmark, "channels_last"]
+        print(f"{benchmark:16s}: NCHW {nchw * 1000:8.1f} ms, channels_last {channels_last * 1000:8.1f} ms "
+              f"({nchw / channels_last:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+'''
+# --------------------------------------------------------------------------------
+#   Output difference and timing of the lossy feature reuse of the sampler
+#   (deep_cache_interval / control_reuse_interval) against full steps.
+#
+#   Runs the UNet and control model of options/SUPIR_v0.yaml on a fixed sequence of
+#   latents and timesteps, first with every step computed, then with the reuse enabled
+#   on the same inputs, and reports the relative error of the model output per step.
+#   Random weights only show the timing, pass the SDXL and SUPIR checkpoints with
+#   --ckpt for meaningful errors.
+#
+#   Run from the ComfyUI directory:
+#   python custom_nodes/ComfyUI-SUPIR/scripts/benchmark_deep_cache.py --interval 2 --ckpt sdxl.safetensors supir.ckpt
+# --------------------------------------------------------------------------------
+'''
+
+import argparse
+import time
+
+from _common import add_common_arguments, build_model, import_package
+
+
+def run(package, model, inputs, cond, interval, depth, control_interval, device):
+    """Runs all steps in one sampling run, returns the outputs and the seconds taken"""
+    import torch
+    attention = package.sgm.modules.attention
+    model.diffusion_model.deep_cache_interval = interval
+    model.diffusion_model.deep_cache_depth = depth
+    model.control_reuse_interval = control_interval
+    outputs = []
+    with torch.no_grad(), attention.context_kv_cache():
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        start = time.perf_counter()
+        for i, (x, t) in enumerate(inputs):
+            attention.set_sampling_step(i)
+            outputs.append(model(x, t, cond).cpu())
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        return outputs, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--interval", type=int, default=2, help="deep_cache_interval")
+    parser.add_argument("--depth", type=int, default=3, help="deep_cache_depth")
+    parser.add_argument("--control-interval", type=int, default=1, help="control_reuse_interval")
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--size", type=int, default=1024, help="image size in pixels, the latent is 8 times smaller")
+    parser.add_argument("--ckpt", nargs="*", default=[], help="SDXL and SUPIR checkpoints")
+    add_common_arguments(parser)
+    args = parser.parse_args()
+
+    package = import_package(args.comfyui)
+    import torch
+    import comfy.model_management
+    device = comfy.model_management.get_torch_device()
+    dtype = package.SUPIR.util.convert_dtype(args.dtype)
+    model = build_model(package, args.ckpt, dtype, device)
+
+    generator = torch.Generator().manual_seed(0)
+    latent = args.size // 8
+    cond = {
+        "crossattn": torch.randn(1, 77, 2048, generator=generator).to(device),
+        "vector": torch.randn(1, 2816, generator=generator).to(device),
+        "control": torch.randn(1, 4, latent, latent, generator=generator).to(device),
+    }
+    # a smooth latent trajectory from noise to the control latent over decreasing timesteps
+    noise = torch.randn(1, 4, latent, latent, generator=generator).to(device)
+    inputs = []
+    for i in range(args.steps):
+        w = i / max(args.steps - 1, 1)
+        t = torch.full((1,), 999 * (1 - w), device=device)
+        inputs.append((noise * (1 - w) + cond["control"] * w, t))
+
+    # warm up
+    run(package, model, inputs[:2], cond, 1, args.depth, 1, device)
+    reference, reference_time = run(package, model, inputs, cond, 1, args.depth, 1, device)
+    cached, cached_time = run(package, model, inputs, cond, args.interval, args.depth, args.control_interval, device)
+
+    errors = []
+    for i, (ref, out) in enumerate(zip(reference, cached)):
+        errors.append(((out.float() - ref.float()).norm() / ref.float().norm().clamp(min=1e-12)).item())
+        print(f"step {i:3d}: relative error {errors[-1]:.5f}")
+    print(f"full steps: {reference_time:.2f}s, interval {args.interval} depth {args.depth} "
+          f"control interval {args.control_interval}: {cached_time:.2f}s "
+          f"({reference_time / cached_time:.2f}x), mean relative error {sum(errors) / len(errors):.5f}, "
+          f"max {max(errors):.5f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+'''
+# --------------------------------------------------------------------------------
+#   Peak memory and time of the ZeroCrossAttn projection with full, chunked
+#   (control_attn_chunk_size) and windowed (control_attn_window_size) attention
+#   across latent sizes.
+#
+#   Builds a ZeroCrossAttn shaped like the full resolution one LightGLVUNet inserts in
+#   XL-base mode (320 control channels into 640 UNet channels) and runs one forward per
+#   mode and latent size, each in its own process. The peak is the increase over the
+#   memory in use before the forward, torch.cuda.max_memory_allocated on CUDA and the
+#   peak RSS on CPU. Full attention is quadratic in the latent area, a mode that runs
+#   out of memory is reported as failed.
+#
+#   Run from the ComfyUI directory:
+#   python custom_nodes/ComfyUI-SUPIR/scripts/benchmark_zero_cross_attn.py --sizes 64 96 128 --chunk 1024 --window 32
+# --------------------------------------------------------------------------------
+'''
+
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import time
+
+from _common import add_common_arguments, import_module, import_package
+
+MODES = ["full", "chunked", "windowed"]
+
+
+def peak_rss():
+    """Peak resident set size of this process in bytes"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def run(args, mode, size):
+    """Runs one forward in this process, returns the peak memory in bytes and the seconds taken"""
+    package = import_package(args.comfyui)
+    import torch
+    import comfy.model_management
+    ZeroCrossAttn = import_module(package, "SUPIR.modules.SUPIR_v0").ZeroCrossAttn
+    device = comfy.model_management.get_torch_device()
+    dtype = package.SUPIR.util.convert_dtype(args.dtype)
+
+    module = ZeroCrossAttn(args.context_channels, args.query_channels)
+    if mode == "chunked":
+        module.attn_chunk_size = args.chunk
+    elif mode == "windowed":
+        module.attn_window_size = args.window
+    module = module.to(dtype).to(device).eval()
+
+    generator = torch.Generator().manual_seed(0)
+    context = torch.randn(1, args.context_channels, size, size, generator=generator).to(dtype).to(device)
+    x = torch.randn(1, args.query_channels, size, size, generator=generator).to(dtype).to(device)
+
+    with torch.no_grad():
+        if device.type == "cuda":
+            # warm up, then measure the peak of a second forward from here on
+            module(context, x)
+            torch.cuda.synchronize(device)
+            torch.cuda.reset_peak_memory_stats(device)
+            base = torch.cuda.memory_allocated(device)
+        else:
+            # the peak RSS can't be reset, so there is no warm up on CPU
+            base = peak_rss()
+        start = time.perf_counter()
+        module(context, x)
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+            peak = torch.cuda.max_memory_allocated(device)
+        else:
+            peak = peak_rss()
+        return peak - base, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[32, 48, 64, 96], help="latent sizes, 8 times smaller than the image")
+    parser.add_argument("--chunk", type=int, default=1024, help="control_attn_chunk_size of the chunked mode")
+    parser.add_argument("--window", type=int, default=32, help="control_attn_window_size of the windowed mode")
+    parser.add_argument("--context-channels", type=int, default=320)
+    parser.add_argument("--query-channels", type=int, default=640)
+    add_common_arguments(parser)
+    parser.add_argument("--run", nargs=2, metavar=("MODE", "SIZE"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run is not None:
+        peak, seconds = run(args, args.run[0], int(args.run[1]))
+        print(peak, seconds)
+        return
+
+    # every measurement runs in a fresh process, so the peak of one doesn't hide the next
+    common = [
+        "--chunk", str(args.chunk), "--window", str(args.window),
+        "--context-channels", str(args.context_channels), "--query-channels", str(args.query_channels),
+        "--dtype", args.dtype, "--comfyui", args.comfyui,
+    ]
+    for size in args.sizes:
+        for mode in MODES:
+            result = subprocess.run([sys.executable, os.path.abspath(__file__), *common, "--run", mode, str(size)],
+                                    capture_output=True, text=True)
+            lines = result.stdout.strip().splitlines()
+            if result.returncode != 0 or not lines:
+                print(f"latent {size}x{size} ({size * 8}px) {mode:8s}: failed, likely out of memory")
+                continue
+            peak, seconds = lines[-1].split()
+            print(f"latent {size}x{size} ({size * 8}px) {mode:8s}: peak {int(peak) / 2 ** 20:9.1f} MiB, "
+                  f"{float(seconds) * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+'''
+# --------------------------------------------------------------------------------
+#   Calibration of the tiled VAE fast mode guard (FAST_MODE_TOLERANCE in
+#   SUPIR/utils/tilevae.py) on real images.
+#
+#   Encodes and decodes each image with the tiled VAE in exact and in fast mode, and
+#   reports the error the fast mode guard measured next to the error of the fast mode
+#   output against the exact output. The tolerance should sit below the guard errors of
+#   the images whose fast mode output is no longer acceptable. The guard is run with
+#   the tolerance disabled, so fast mode is always used here.
+#
+#   Run from the ComfyUI directory:
+#   python custom_nodes/ComfyUI-SUPIR/scripts/check_fast_mode.py --ckpt sdxl.safetensors --images a.png b.jpg
+# --------------------------------------------------------------------------------
+'''
+
+import argparse
+import math
+import os
+
+from _common import add_common_arguments, build_vae, import_module, import_package
+
+
+def load_image(path, dtype, device):
+    import numpy as np
+    import torch
+    from PIL import Image
+    image = np.asarray(Image.open(path).convert("RGB"), dtype=np.float32) / 127.5 - 1.0
+    # the VAE needs sizes divisible by 8
+    h, w = image.shape[0] // 8 * 8, image.shape[1] // 8 * 8
+    return torch.from_numpy(image[:h, :w]).permute(2, 0, 1).unsqueeze(0).to(dtype).to(device)
+
+
+def psnr(x, reference):
+    """PSNR of x against reference, both in -1..1"""
+    mse = ((x.float() - reference.float()) ** 2).mean().item()
+    return float("inf") if mse == 0 else 10 * math.log10(4.0 / mse)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ckpt", required=True, help="SDXL or SUPIR checkpoint with the VAE weights")
+    parser.add_argument("--images", nargs="+", required=True)
+    parser.add_argument("--encoder-tile-size", type=int, default=512, help="in pixels")
+    parser.add_argument("--decoder-tile-size", type=int, default=512, help="in pixels")
+    add_common_arguments(parser)
+    args = parser.parse_args()
+
+    package = import_package(args.comfyui)
+    import torch
+    import comfy.model_management
+    VAEHook = import_module(package, "SUPIR.utils.tilevae").VAEHook
+
+    class GuardedVAEHook(VAEHook):
+        """VAEHook that keeps the error measured by the fast mode guard"""
+        guard_error = None
+
+        def fast_mode_error(self, *args, **kwargs):
+            self.guard_error = super().fast_mode_error(*args, **kwargs)
+            return self.guard_error
+
+    device = comfy.model_management.get_torch_device()
+    dtype = package.SUPIR.util.convert_dtype(args.dtype)
+    vae = build_vae(package, [args.ckpt], dtype, device)
+
+    def hooks(net, tile_size, is_decoder):
+        exact = VAEHook(net, tile_size, is_decoder=is_decoder, fast_decoder=False, fast_encoder=False, color_fix=False)
+        fast = GuardedVAEHook(net, tile_size, is_decoder=is_decoder, fast_decoder=is_decoder, fast_encoder=not is_decoder,
+                              color_fix=False, fast_tolerance=float("inf"))
+        return exact, fast
+
+    encoder, fast_encoder = hooks(vae.encoder, args.encoder_tile_size, False)
+    decoder, fast_decoder = hooks(vae.decoder, args.decoder_tile_size // 8, True)
+
+    with torch.no_grad():
+        for path in args.images:
+            image = load_image(path, dtype, device)
+            exact_z = vae.quant_conv(encoder(image))[:, :4]
+            fast_z = vae.quant_conv(fast_encoder(image))[:, :4]
+            exact_image = decoder(vae.post_quant_conv(exact_z))
+            fast_image = fast_decoder(vae.post_quant_conv(exact_z))
+            z_error = ((fast_z.float() - exact_z.float()).norm() / exact_z.float().norm().clamp(min=1e-6)).item()
+            print(f"{os.path.basename(path)} {image.shape[3]}x{image.shape[2]}:")
+            print(f"  encoder: guard error {fast_encoder.guard_error}, relative latent error {z_error:.5f}")
+            print(f"  decoder: guard error {fast_decoder.guard_error}, "
+                  f"PSNR against exact {psnr(fast_image, exact_image):.2f} dB")
+
+
+if __name__ == "__main__":
+    main()
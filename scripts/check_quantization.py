@@ -0,0 +1,62 @@
+'''
+# --------------------------------------------------------------------------------
+#   CPU accuracy check of the weight-only quantization (SUPIR/utils/quantize.py).
+#
+#   Quantizes Linear and Conv layers shaped like the ones of the SDXL UNet to int8
+#   and fp8 and checks the relative output error against the fp16 reference with
+#   output_error. Only needs PyTorch, exits with an error if a bound is exceeded.
+#
+#   python scripts/check_quantization.py
+# --------------------------------------------------------------------------------
+'''
+
+import importlib.util
+import os
+import sys
+
+import torch
+import torch.nn as nn
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# relative output error bounds against the fp16 reference
+ERROR_BOUNDS = {"int8": 0.01, "fp8": 0.05}
+
+
+def load_quantize():
+    # quantize.py only depends on torch, load it without importing the node pack and ComfyUI
+    path = os.path.join(PACKAGE_DIR, "SUPIR", "utils", "quantize.py")
+    spec = importlib.util.spec_from_file_location("supir_quantize", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def representative_layers():
+    """(name, layer, input) of the common layer shapes of the UNet"""
+    return [
+        ("attention projection", nn.Linear(1280, 1280), torch.randn(2, 64, 1280)),
+        ("feed forward", nn.Linear(1280, 5120), torch.randn(2, 64, 1280)),
+        ("resblock conv", nn.Conv2d(640, 640, 3, padding=1), torch.randn(1, 640, 32, 32)),
+        ("skip conv", nn.Conv2d(960, 640, 1), torch.randn(1, 960, 32, 32)),
+    ]
+
+
+def main():
+    quantize = load_quantize()
+    torch.manual_seed(0)
+    failed = False
+    for mode, bound in ERROR_BOUNDS.items():
+        if mode == "fp8" and not hasattr(torch, "float8_e4m3fn"):
+            print("fp8: skipped, needs PyTorch 2.1 or newer")
+            continue
+        for name, layer, x in representative_layers():
+            error = quantize.output_error(layer, x, mode)
+            ok = error <= bound
+            failed |= not ok
+            print(f"{mode} {name}: relative output error {error:.5f} (bound {bound}) {'ok' if ok else 'FAILED'}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
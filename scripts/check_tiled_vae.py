@@ -0,0 +1,209 @@
+'''
+# --------------------------------------------------------------------------------
+#   CPU equivalence check of the tiled VAE executor (VAEHook.vae_tile_forward in
+#   SUPIR/utils/tilevae.py) against the per tile task queue executor it replaced.
+#
+#   The queue executor is kept here as QueueVAEHook: every tile runs through its own
+#   copy of the task queue, one tile at a time, with the residuals stored in the queue.
+#   Both run the same layers, tiling and group norm statistics on the VAE of
+#   options/SUPIR_v0.yaml with random weights in fp32 on the CPU, for the encoder with
+#   and without fast mode and color_fix and the decoder with and without fast mode,
+#   each with tile_batch_size 1 and above 1. The fast mode guard is disabled, the
+#   estimated group norms are always used like the queue executor did. Exits with 1 if
+#   an output differs by more than the tolerance.
+#
+#   Run from the ComfyUI directory:
+#   python custom_nodes/ComfyUI-SUPIR/scripts/check_tiled_vae.py --width 320 --height 256 --tile-batch-size 4
+# --------------------------------------------------------------------------------
+'''
+
+import argparse
+import sys
+
+from _common import add_common_arguments, build_vae, import_module, import_package
+
+
+def queue_hook_class(tilevae):
+    """The queue executor as a VAEHook, bound to the tilevae module of the node pack"""
+    import torch
+    import torch.nn.functional as F
+
+    class QueueVAEHook(tilevae.VAEHook):
+        def estimate_group_norm(self, z, task_queue, color_fix):
+            """Replaces the group norms of task_queue in place, the residuals are stored in the add_res tasks"""
+            device = z.device
+            tile = z
+            last_id = len(task_queue) - 1
+            while last_id >= 0 and task_queue[last_id][0] != 'pre_norm':
+                last_id -= 1
+            for i in range(last_id + 1):
+                task = task_queue[i]
+                if task[0] == 'pre_norm':
+                    group_norm_func = tilevae.GroupNormParam.from_tile(tile, task[1])
+                    task_queue[i] = ['apply_norm', group_norm_func]
+                    if i == last_id:
+                        return True
+                    tile = group_norm_func(tile)
+                elif task[0] == 'store_res':
+                    task_id = i + 1
+                    while task_id < last_id and task_queue[task_id][0] != 'add_res':
+                        task_id += 1
+                    if task_id >= last_id:
+                        continue
+                    task_queue[task_id][1] = task[1](tile)
+                elif task[0] == 'add_res':
+                    tile += task[1].to(device)
+                    task[1] = None
+                elif color_fix and task[0] == 'downsample':
+                    for j in range(i, last_id + 1):
+                        if task_queue[j][0] == 'store_res':
+                            task_queue[j] = ['store_res_cpu', task_queue[j][1]]
+                    return True
+                else:
+                    tile = task[1](tile)
+            return True
+
+        @torch.no_grad()
+        def vae_tile_forward(self, z):
+            device = next(self.net.parameters()).device
+            dtype = z.dtype
+            is_decoder = self.is_decoder
+            N, height, width = z.shape[0], z.shape[2], z.shape[3]
+            in_bboxes, out_bboxes = self.split_tiles(height, width)
+            tiles = [z[:, :, bbox[2]:bbox[3], bbox[0]:bbox[1]].cpu() for bbox in in_bboxes]
+            num_tiles = len(tiles)
+
+            single_task_queue = [list(task) for task in tilevae.build_task_queue(self.net, is_decoder)]
+            if self.fast_mode:
+                downsampled_z = F.interpolate(z, scale_factor=self.tile_size / max(height, width), mode='nearest-exact')
+                std_old, mean_old = torch.std_mean(z, dim=[0, 2, 3], keepdim=True)
+                std_new, mean_new = torch.std_mean(downsampled_z, dim=[0, 2, 3], keepdim=True)
+                downsampled_z = (downsampled_z - mean_new) / std_new * std_old + mean_old
+                downsampled_z = torch.clamp_(downsampled_z, min=z.min(), max=z.max())
+                estimate_task_queue = [list(task) for task in single_task_queue]
+                if self.estimate_group_norm(downsampled_z, estimate_task_queue, color_fix=self.color_fix):
+                    single_task_queue = estimate_task_queue
+            task_queues = [[list(task) for task in single_task_queue] for _ in range(num_tiles)]
+
+            result = None
+            num_completed = 0
+            forward = True
+            while True:
+                group_norm_param = tilevae.GroupNormParam()
+                for i in range(num_tiles) if forward else reversed(range(num_tiles)):
+                    tile = tiles[i].to(device)
+                    task_queue = task_queues[i]
+                    while len(task_queue) > 0:
+                        task = task_queue.pop(0)
+                        if task[0] == 'pre_norm':
+                            group_norm_param.add_tile(tile, task[1])
+                            break
+                        elif task[0] == 'store_res' or task[0] == 'store_res_cpu':
+                            task_id = 0
+                            res = task[1](tile)
+                            if not self.fast_mode or task[0] == 'store_res_cpu':
+                                res = res.cpu()
+                            while task_queue[task_id][0] != 'add_res':
+                                task_id += 1
+                            task_queue[task_id][1] = res
+                        elif task[0] == 'add_res':
+                            tile += task[1].to(device)
+                            task[1] = None
+                        else:
+                            tile = task[1](tile)
+
+                    if len(task_queue) == 0:
+                        tiles[i] = None
+                        num_completed += 1
+                        if result is None:
+                            result = torch.zeros((N, tile.shape[1], height * 8 if is_decoder else height // 8,
+                                                  width * 8 if is_decoder else width // 8), device=device)
+                        result[:, :, out_bboxes[i][2]:out_bboxes[i][3], out_bboxes[i][0]:out_bboxes[i][1]] = \
+                            tilevae.crop_valid_region(tile, in_bboxes[i], out_bboxes[i], is_decoder)
+                    elif i == num_tiles - 1 and forward:
+                        forward = False
+                        tiles[i] = tile
+                    elif i == 0 and not forward:
+                        forward = True
+                        tiles[i] = tile
+                    else:
+                        tiles[i] = tile.cpu()
+
+                if num_completed == num_tiles:
+                    break
+
+                group_norm_func = group_norm_param.summary()
+                for task_queue in task_queues:
+                    task_queue.insert(0, ['apply_norm', group_norm_func])
+
+            return result.to(dtype)
+
+    return QueueVAEHook
+
+
+def configurations(tile_batch_size):
+    """(name, is_decoder, fast, color_fix, tile_batch_size) of every checked configuration"""
+    for is_decoder in (False, True):
+        for fast in (False, True):
+            # color_fix only changes the fast mode estimation of the encoder
+            for color_fix in ((False, True) if fast and not is_decoder else (False,)):
+                for batch_size in (1, tile_batch_size):
+                    name = (f"{'decoder' if is_decoder else 'encoder'} fast={fast:d} color_fix={color_fix:d} "
+                            f"tile_batch_size={batch_size}")
+                    yield name, is_decoder, fast, color_fix, batch_size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--width", type=int, default=320, help="image width in pixels, a multiple of 8")
+    parser.add_argument("--height", type=int, default=256, help="image height in pixels, a multiple of 8")
+    parser.add_argument("--encoder-tile-size", type=int, default=64, help="in pixels")
+    parser.add_argument("--decoder-tile-size", type=int, default=64, help="in pixels")
+    parser.add_argument("--tile-batch-size", type=int, default=4, help="the tile_batch_size above 1 that is checked")
+    parser.add_argument("--tolerance", type=float, default=1e-4, help="max relative error against the queue executor")
+    add_common_arguments(parser)
+    parser.set_defaults(dtype="fp32")
+    args = parser.parse_args()
+
+    package = import_package(args.comfyui)
+    import torch
+    tilevae = import_module(package, "SUPIR.utils.tilevae")
+    QueueVAEHook = queue_hook_class(tilevae)
+
+    device = torch.device("cpu")
+    dtype = package.SUPIR.util.convert_dtype(args.dtype)
+    vae = build_vae(package, [], dtype, device)
+
+    generator = torch.Generator().manual_seed(0)
+    inputs = {
+        False: torch.rand(1, 3, args.height, args.width, generator=generator).to(dtype) * 2 - 1,
+        True: torch.randn(1, 4, args.height // 8, args.width // 8, generator=generator).to(dtype),
+    }
+
+    def hook(cls, is_decoder, fast, color_fix, **kwargs):
+        net = vae.decoder if is_decoder else vae.encoder
+        tile_size = args.decoder_tile_size // 8 if is_decoder else args.encoder_tile_size
+        return cls(net, tile_size, is_decoder=is_decoder, fast_decoder=fast, fast_encoder=fast, color_fix=color_fix, **kwargs)
+
+    failed = False
+    references = {}
+    with torch.no_grad():
+        for name, is_decoder, fast, color_fix, batch_size in configurations(args.tile_batch_size):
+            x = inputs[is_decoder]
+            key = is_decoder, fast, color_fix
+            if key not in references:
+                references[key] = hook(QueueVAEHook, is_decoder, fast, color_fix)(x).float()
+            reference = references[key]
+            out = hook(tilevae.VAEHook, is_decoder, fast, color_fix, tile_batch_size=batch_size,
+                       fast_tolerance=float("inf"))(x).float()
+            max_error = (out - reference).abs().max().item()
+            error = ((out - reference).norm() / reference.norm().clamp(min=1e-6)).item()
+            ok = error <= args.tolerance
+            failed = failed or not ok
+            print(f"{name:50s}: max abs error {max_error:.3e}, relative error {error:.3e} {'ok' if ok else 'FAILED'}")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
 import math
+from contextlib import contextmanager
 from inspect import isfunction
 from typing import Any, Optional
 
@@ -9,6 +10,7 @@ import torch.nn.functional as F
 from einops import rearrange, repeat
 from packaging import version
 from torch import nn
+import comfy.model_management
 
 class Conv2d(torch.nn.Conv2d):
     def reset_parameters(self):
@@ -60,7 +62,261 @@ except:
     XFORMERS_IS_AVAILABLE = False
     print("no module 'xformers'. Processing without...")
 
-from .diffusionmodules.util import checkpoint
+from .diffusionmodules.util import checkpoint, memory_format
+
+
+class ContextKVCache:
+    """
+    Holds tensors derived from the constant conditioning during one sampling run, such as
+    the cross-attention K/V projections and the label embeddings. Entries are keyed by the
+    identity of their source tensors and keep a reference to them, so ids can't be recycled
+    while cached. The K/V projections are only cached when cache_kv is set.
+    Conditioning stacked along the batch dim records its parts, so that the K/V projections
+    are cached once per distinct part instead of once per stacked tensor, see stacked_cat.
+    """
+
+    def __init__(self, cache_kv=True):
+        self.entries = {}
+        self.states = {}
+        # id of a stacked tensor -> (tensor, parts along the batch dim)
+        self.stacks = {}
+        self.cache_kv = cache_kv
+        # index and sigma of the running sampler step, set by the sampling loops
+        self.step = None
+        self.sigma = None
+        # index of the tile batch the tiled samplers are running, None for untiled sampling
+        self.tile = None
+
+    def get(self, key, sources, fn):
+        key = key + _tensor_keys(sources)
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = (sources, fn())
+            self.entries[key] = entry
+        return entry[1]
+
+    def state(self, key, sources):
+        """Mutable dict for state that has to persist across the steps of the run"""
+        key = key + _tensor_keys(sources)
+        entry = self.states.get(key)
+        if entry is None:
+            entry = (sources, {})
+            self.states[key] = entry
+        return entry[1]
+
+    def set_parts(self, t, parts):
+        flat = tuple(part for p in parts for part in self.parts(p))
+        if len(flat) > 1:
+            self.stacks[id(t)] = (t, flat)
+
+    def parts(self, t):
+        """The tensors t was stacked from along the batch dim, or just t"""
+        entry = self.stacks.get(id(t))
+        return entry[1] if entry is not None else (t,)
+
+    def clear(self):
+        self.entries.clear()
+        self.states.clear()
+        self.stacks.clear()
+        self.step = None
+        self.sigma = None
+        self.tile = None
+
+
+def _tensor_keys(sources):
+    # tensors created under torch.inference_mode() carry no version counter
+    return tuple((id(t), 0 if t.is_inference() else t._version) for t in sources)
+
+
+_context_kv_cache = None
+
+
+@contextmanager
+def context_kv_cache(enabled=True, cache_kv=True):
+    """
+    Enables the conditioning cache for the enclosed sampling run and clears it on exit.
+    """
+    global _context_kv_cache
+    if not enabled or _context_kv_cache is not None:
+        yield _context_kv_cache
+        return
+    _context_kv_cache = ContextKVCache(cache_kv=cache_kv)
+    try:
+        yield _context_kv_cache
+    finally:
+        _context_kv_cache.clear()
+        _context_kv_cache = None
+
+
+def cached_cast(t, dtype):
+    """
+    Casts the conditioning to dtype, reusing the same converted tensor across steps
+    while the context K/V cache is active so its identity stays stable.
+    """
+    if _context_kv_cache is None or t is None or t.dtype == dtype:
+        return t if t is None else t.to(dtype)
+
+    def cast():
+        out = t.to(dtype)
+        parts = _context_kv_cache.parts(t)
+        if len(parts) > 1:
+            _context_kv_cache.set_parts(out, [cached_cast(p, dtype) for p in parts])
+        return out
+    return _context_kv_cache.get(("cast", dtype), (t,), cast)
+
+
+def cached_call(key, sources, fn):
+    """
+    Returns fn(), memoized on the identity of the source tensors while the cache is active.
+    """
+    if _context_kv_cache is None or any(t is None for t in sources):
+        return fn()
+    return _context_kv_cache.get(key, tuple(sources), fn)
+
+
+def cached_state(key, sources):
+    """
+    Returns the per run state dict for the source tensors, or None when the cache is not active.
+    """
+    if _context_kv_cache is None or any(t is None for t in sources):
+        return None
+    return _context_kv_cache.state(key, tuple(sources))
+
+
+def set_sampling_step(step, sigma=None):
+    """
+    Records the index and the sigma (a float on the host) of the running sampler step while the cache is active.
+    """
+    if _context_kv_cache is not None:
+        _context_kv_cache.step = step
+        _context_kv_cache.sigma = sigma
+
+
+def sampling_sigma():
+    """
+    The sigma of the running sampler step, or None if unknown, read without a device sync.
+    """
+    return None if _context_kv_cache is None else _context_kv_cache.sigma
+
+
+def set_sampling_tile(tile):
+    """
+    Records the index of the tile batch the tiled samplers are running while the cache is active,
+    the state of the step based feature reuse is kept per tile batch.
+    """
+    if _context_kv_cache is not None:
+        _context_kv_cache.tile = tile
+
+
+def sampling_tile():
+    """
+    The index of the running tile batch, None for untiled sampling.
+    """
+    return None if _context_kv_cache is None else _context_kv_cache.tile
+
+
+def cached_step_state(key, sources, interval, feature, allow_reuse=True):
+    """
+    Per run state for features that are computed every interval sampler steps and reused on the steps in between.
+    Returns the state dict and whether state[feature] is reused on this step. Features are only reused over
+    consecutive steps of the same conditioning, after a gap (guidance interval, skipped CFG) or a second call
+    within a step they are recomputed. When not reused, the caller computes the features and may store them.
+    """
+    state = cached_state(key, sources)
+    if state is None or _context_kv_cache.step is None:
+        return None, False
+    step = _context_kv_cache.step
+    last_step = state.get("last_step")
+    state["last_step"] = step
+    if allow_reuse and last_step == step - 1 and feature in state and state["age"] + 1 < interval:
+        state["age"] += 1
+        return state, True
+    state.pop(feature, None)
+    state["age"] = 0
+    return state, False
+
+
+def context_kv(attn, x, context=None):
+    """
+    K/V projections of the attention module attn, shared by CrossAttention and MemoryEfficientCrossAttention.
+    With attn.cache_context_kv the projections of the constant text context are computed once per run.
+    """
+    if context is not None and attn.cache_context_kv and _context_kv_cache is not None and _context_kv_cache.cache_kv:
+        # the text context is constant over the sampling run, project it only once per distinct prompt,
+        # a stacked context (tiles, CFG) is put together from the projections of its parts
+        kvs = [
+            _context_kv_cache.get(("kv", id(attn)), (part,), lambda part=part: (attn.to_k(part), attn.to_v(part)))
+            for part in _context_kv_cache.parts(context)
+        ]
+        if len(kvs) == 1:
+            return kvs[0]
+        return torch.cat([k for k, _ in kvs]), torch.cat([v for _, v in kvs])
+    context = default(context, x)
+    return attn.to_k(context), attn.to_v(context)
+
+
+def cached_cat(tensors, dim=0):
+    """
+    torch.cat for constant conditioning, memoized while the context K/V cache is active.
+    """
+    if _context_kv_cache is None:
+        return torch.cat(tensors, dim)
+    return _context_kv_cache.get(("cat", dim), tuple(tensors), lambda: stacked_cat(tensors, dim))
+
+
+def stacked_cat(tensors, dim=0):
+    """
+    torch.cat for conditioning stacked along the batch dim, e.g. the same prompt for every tile of a batch.
+    While the cache is active the parts of the result are recorded, so that tensors computed from it
+    per batch row, like the K/V projections, are computed once per distinct part.
+    """
+    out = torch.cat(tensors, dim)
+    if _context_kv_cache is not None and dim == 0:
+        _context_kv_cache.set_parts(out, tensors)
+    return out
+
+
+def chunked_scaled_dot_product_attention(q, k, v, chunk_size, attn_mask=None):
+    """
+    F.scaled_dot_product_attention on (b, h, n, d) tensors, evaluated over chunks of chunk_size queries
+    so the attention matrix never exceeds chunk_size x keys, e.g. with the math backend on CPU.
+    attn_mask has to broadcast over the query dim.
+    """
+    if chunk_size <= 0 or q.shape[-2] <= chunk_size:
+        return F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask)
+    out = q.new_empty(q.shape[:-1] + v.shape[-1:])
+    for i in range(0, q.shape[-2], chunk_size):
+        out[..., i:i + chunk_size, :] = F.scaled_dot_product_attention(
+            q[..., i:i + chunk_size, :], k, v, attn_mask=attn_mask
+        )
+    return out
+
+
+# size in bytes of the attention scores above which the "auto" attn_slicing mode slices the queries
+ATTN_SLICE_THRESHOLD = 512 * 1024 ** 2
+
+
+def use_sliced_attention(attn_slicing, q, k):
+    """
+    attn_slicing is "sliced", "sdpa" or "auto". Auto slices when the score tensor would be large and
+    the device has no memory efficient SDPA kernels to avoid materializing it (anything but CUDA).
+    """
+    if attn_slicing == "sliced":
+        return True
+    if attn_slicing != "auto" or q.device.type == "cuda":
+        return False
+    return q.shape[0] * q.shape[1] * q.shape[-2] * k.shape[-2] * q.element_size() > ATTN_SLICE_THRESHOLD
+
+
+def sliced_scaled_dot_product_attention(q, k, v, attn_mask=None):
+    """
+    Query sliced attention on (b, h, n, d) tensors, the slices are sized so the scores of a slice
+    and their softmax temporaries use at most a quarter of the free memory.
+    """
+    bytes_per_query = q.shape[0] * q.shape[1] * k.shape[-2] * q.element_size() * 3
+    budget = comfy.model_management.get_free_memory(q.device) // 4
+    chunk_size = max(1, min(q.shape[-2], int(budget // bytes_per_query)))
+    return chunked_scaled_dot_product_attention(q, k, v, chunk_size, attn_mask=attn_mask)
 
 
 def exists(val):
@@ -226,6 +482,9 @@ class CrossAttention(nn.Module):
             Linear(inner_dim, query_dim), nn.Dropout(dropout)
         )
         self.backend = backend
+        self.cache_context_kv = False
+        # "auto", "sdpa" or "sliced", see use_sliced_attention
+        self.attn_slicing = "auto"
 
     def forward(
         self,
@@ -244,9 +503,7 @@ class CrossAttention(nn.Module):
             x = torch.cat([additional_tokens, x], dim=1)
 
         q = self.to_q(x)
-        context = default(context, x)
-        k = self.to_k(context)
-        v = self.to_v(context)
+        k, v = context_kv(self, x, context)
 
         if n_times_crossframe_attn_in_self:
             # reprogramming cross-frame attention as in https://arxiv.org/abs/2303.13439
@@ -278,11 +535,14 @@ class CrossAttention(nn.Module):
         out = einsum('b i j, b j d -> b i d', sim, v)
         """
         ## new
-        with sdp_kernel(**BACKEND_MAP[self.backend]):
-            # print("dispatching into backend", self.backend, "q/k/v shape: ", q.shape, k.shape, v.shape)
-            out = F.scaled_dot_product_attention(
-                q, k, v, attn_mask=mask
-            )  # scale is dim_head ** -0.5 per default
+        if mask is None and use_sliced_attention(self.attn_slicing, q, k):
+            out = sliced_scaled_dot_product_attention(q, k, v)
+        else:
+            with sdp_kernel(**BACKEND_MAP[self.backend]):
+                # print("dispatching into backend", self.backend, "q/k/v shape: ", q.shape, k.shape, v.shape)
+                out = F.scaled_dot_product_attention(
+                    q, k, v, attn_mask=mask
+                )  # scale is dim_head ** -0.5 per default
 
         del q, k, v
         out = rearrange(out, "b h n d -> b n (h d)", h=h)
@@ -317,6 +577,7 @@ class MemoryEfficientCrossAttention(nn.Module):
             Linear(inner_dim, query_dim), nn.Dropout(dropout)
         )
         self.attention_op: Optional[Any] = None
+        self.cache_context_kv = False
 
     def forward(
         self,
@@ -332,9 +593,7 @@ class MemoryEfficientCrossAttention(nn.Module):
             # add additional token
             x = torch.cat([additional_tokens, x], dim=1)
         q = self.to_q(x)
-        context = default(context, x)
-        k = self.to_k(context)
-        v = self.to_v(context)
+        k, v = context_kv(self, x, context)
 
         if n_times_crossframe_attn_in_self:
             # reprogramming cross-frame attention as in https://arxiv.org/abs/2303.13439
@@ -442,6 +701,8 @@ class BasicTransformerBlock(nn.Module):
             dropout=dropout,
             backend=sdp_backend,
         )  # is self-attn if context is none
+        self.attn1.cache_context_kv = self.disable_self_attn
+        self.attn2.cache_context_kv = True
         self.norm1 = nn.LayerNorm(dim)
         self.norm2 = nn.LayerNorm(dim)
         self.norm3 = nn.LayerNorm(dim)
@@ -637,7 +898,7 @@ class SpatialTransformer(nn.Module):
             x = block(x, context=context[i])
         if self.use_linear:
             x = self.proj_out(x)
-        x = rearrange(x, "b (h w) c -> b c h w", h=h, w=w).contiguous()
+        x = rearrange(x, "b (h w) c -> b c h w", h=h, w=w).contiguous(memory_format=memory_format(x_in))
         if not self.use_linear:
             x = self.proj_out(x)
         return x + x_in
@@ -1,3 +1,4 @@
+import torch
 import torch.nn as nn
 
 from ...util import append_dims, instantiate_from_config
@@ -44,11 +45,19 @@ class DiscreteDenoiser(Denoiser):
             num_idx, do_append_zero=do_append_zero, flip=flip
         )
         self.register_buffer("sigmas", sigmas)
+        # sorted copy of the sigmas for the nearest neighbour search in sigma_to_idx
+        sorted_sigmas, sorted_idx = torch.sort(sigmas)
+        self.register_buffer("sorted_sigmas", sorted_sigmas, persistent=False)
+        self.register_buffer("sorted_idx", sorted_idx, persistent=False)
         self.quantize_c_noise = quantize_c_noise
 
     def sigma_to_idx(self, sigma):
-        dists = sigma - self.sigmas[:, None]
-        return dists.abs().argmin(dim=0).view(sigma.shape)
+        # binary search for the closest sigma, avoids the (num_idx x B) distance matrix of an argmin
+        flat_sigma = sigma.reshape(-1).to(self.sorted_sigmas.dtype)
+        right = torch.searchsorted(self.sorted_sigmas, flat_sigma).clamp_(1, len(self.sorted_sigmas) - 1)
+        left = right - 1
+        use_left = (flat_sigma - self.sorted_sigmas[left]).abs() <= (self.sorted_sigmas[right] - flat_sigma).abs()
+        return self.sorted_idx[torch.where(use_left, left, right)].view(sigma.shape)
 
     def idx_to_sigma(self, idx):
         return self.sigmas[idx]
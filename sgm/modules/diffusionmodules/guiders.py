@@ -3,16 +3,49 @@ from functools import partial
 import torch
 
 from ...util import default, instantiate_from_config
+from ..attention import cached_cat
 
 
-class VanillaCFG:
+CFG_KEYS = ["vector", "crossattn", "concat", "control", 'control_vector', 'mask_x']
+
+
+class Guider:
     """
-    implements parallelized CFG
+    base of the guiders, runs the denoiser for one evaluation of a sampler step
     """
+    sequential = False
 
-    def __init__(self, scale, dyn_thresh_config=None):
-        scale_schedule = lambda scale, sigma: scale  # independent of step
-        self.scale_schedule = partial(scale_schedule, scale)
+    def prepare_schedule(self, sigmas):
+        """Called by the samplers with the sigma schedule of the run, a list of floats, before the first step"""
+        pass
+
+    def set_step(self, step):
+        """Called by the samplers with the index of the running step"""
+        pass
+
+    def skip_uncond(self, sigma):
+        return False
+
+    def guide(self, denoiser, x, sigma, cond, uc, *args):
+        """Returns the guided denoiser output, args are passed on to the denoiser"""
+        if self.skip_uncond(sigma):
+            return denoiser(x, sigma, cond, *args)
+        if self.sequential:
+            denoised = torch.cat([denoiser(*inputs, *args)
+                                  for inputs in self.prepare_sequential_inputs(x, sigma, cond, uc)])
+        else:
+            denoised = denoiser(*self.prepare_inputs(x, sigma, cond, uc), *args)
+        return self(denoised, sigma)
+
+
+class CFGGuider(Guider):
+    """
+    implements parallelized CFG, or sequential CFG (one forward per branch) when sequential is set
+    """
+
+    def __init__(self, scale_schedule, dyn_thresh_config=None, sequential=False):
+        self.scale_schedule = scale_schedule
+        self.sequential = sequential
         self.dyn_thresh = instantiate_from_config(
             default(
                 dyn_thresh_config,
@@ -32,50 +65,71 @@ class VanillaCFG:
         c_out = dict()
 
         for k in c:
-            if k in ["vector", "crossattn", "concat", "control", 'control_vector', 'mask_x']:
-                c_out[k] = torch.cat((uc[k], c[k]), 0)
+            if k in CFG_KEYS:
+                c_out[k] = cached_cat((uc[k], c[k]), 0)
             else:
                 assert c[k] == uc[k]
                 c_out[k] = c[k]
         return torch.cat([x] * 2), torch.cat([s] * 2), c_out
 
+    def prepare_sequential_inputs(self, x, s, c, uc):
+        # uc and c are evaluated one after another instead of at double batch, halving the peak activation memory
+        for k in c:
+            if k not in CFG_KEYS:
+                assert c[k] == uc[k]
+        return [(x, s, uc), (x, s, c)]
+
+
+class VanillaCFG(CFGGuider):
+    def __init__(self, scale, dyn_thresh_config=None, sequential=False):
+        scale_schedule = lambda scale, sigma: scale  # independent of step
+        super().__init__(partial(scale_schedule, scale), dyn_thresh_config=dyn_thresh_config, sequential=sequential)
 
 
-class LinearCFG:
-    def __init__(self, scale, scale_min=None, dyn_thresh_config=None):
+class LinearCFG(CFGGuider):
+    def __init__(self, scale, scale_min=None, dyn_thresh_config=None, sequential=False):
         if scale_min is None:
             scale_min = scale
         scale_schedule = lambda scale, scale_min, sigma: (scale - scale_min) * sigma / 14.6146 + scale_min
-        self.scale_schedule = partial(scale_schedule, scale, scale_min)
-        self.dyn_thresh = instantiate_from_config(
-            default(
-                dyn_thresh_config,
-                {
-                    "target": ".sgm.modules.diffusionmodules.sampling_utils.NoDynamicThresholding"
-                },
-            )
-        )
+        super().__init__(partial(scale_schedule, scale, scale_min), dyn_thresh_config=dyn_thresh_config,
+                         sequential=sequential)
 
-    def __call__(self, x, sigma):
-        x_u, x_c = x.chunk(2)
-        scale_value = self.scale_schedule(sigma)
-        x_pred = self.dyn_thresh(x_u, x_c, scale_value)
-        return x_pred
 
-    def prepare_inputs(self, x, s, c, uc):
-        c_out = dict()
+class GuidanceIntervalCFG(LinearCFG):
+    """
+    LinearCFG that only runs the unconditional branch while sigma is inside [sigma_min, sigma_max]
+    and the scale differs from 1 by more than scale_threshold, other steps use a single conditional forward
+    """
 
-        for k in c:
-            if k in ["vector", "crossattn", "concat", "control", 'control_vector', 'mask_x']:
-                c_out[k] = torch.cat((uc[k], c[k]), 0)
-            else:
-                assert c[k] == uc[k]
-                c_out[k] = c[k]
-        return torch.cat([x] * 2), torch.cat([s] * 2), c_out
+    def __init__(self, scale, scale_min=None, dyn_thresh_config=None, sequential=False,
+                 sigma_min=0.0, sigma_max=float("inf"), scale_threshold=0.0):
+        super().__init__(scale, scale_min=scale_min, dyn_thresh_config=dyn_thresh_config, sequential=sequential)
+        self.sigma_min = sigma_min
+        self.sigma_max = sigma_max
+        self.scale_threshold = scale_threshold
+        self.skip_steps = None
+        self.step = None
+
+    def prepare_schedule(self, sigmas):
+        # decided once per run on the host, so the denoiser calls don't wait on a device sync for sigma
+        self.skip_steps = None if sigmas is None else [self.skip_sigma(sigma) for sigma in sigmas]
+        self.step = None
+
+    def set_step(self, step):
+        self.step = step
+
+    def skip_sigma(self, sigma):
+        if not self.sigma_min <= sigma <= self.sigma_max:
+            return True
+        return abs(self.scale_schedule(sigma) - 1.0) <= self.scale_threshold
 
+    def skip_uncond(self, sigma):
+        if self.skip_steps is not None and self.step is not None:
+            return self.skip_steps[self.step]
+        return self.skip_sigma(sigma[0].item())
 
 
-class IdentityGuider:
+class IdentityGuider(Guider):
     def __call__(self, x, sigma):
         return x
 
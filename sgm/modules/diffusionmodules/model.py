@@ -17,7 +17,8 @@ except:
     XFORMERS_IS_AVAILABLE = False
     print("no module 'xformers'. Processing without...")
 
-from ...modules.attention import LinearAttention, MemoryEfficientCrossAttention
+from ...modules.attention import LinearAttention, MemoryEfficientCrossAttention, use_sliced_attention, \
+    sliced_scaled_dot_product_attention
 
 class Conv2d(torch.nn.Conv2d):
     def reset_parameters(self):
@@ -190,6 +191,8 @@ class AttnBlock(nn.Module):
         self.proj_out = Conv2d(
             in_channels, in_channels, kernel_size=1, stride=1, padding=0
         )
+        # "auto", "sdpa" or "sliced", see use_sliced_attention
+        self.attn_slicing = "auto"
 
     def attention(self, h_: torch.Tensor) -> torch.Tensor:
         h_ = self.norm(h_)
@@ -201,9 +204,13 @@ class AttnBlock(nn.Module):
         q, k, v = map(
             lambda x: rearrange(x, "b c h w -> b 1 (h w) c").contiguous(), (q, k, v)
         )
-        h_ = torch.nn.functional.scaled_dot_product_attention(
-            q, k, v
-        )  # scale is dim ** -0.5 per default
+        if use_sliced_attention(self.attn_slicing, q, k):
+            # the single head HW x HW scores get huge for large untiled images
+            h_ = sliced_scaled_dot_product_attention(q, k, v)
+        else:
+            h_ = torch.nn.functional.scaled_dot_product_attention(
+                q, k, v
+            )  # scale is dim ** -0.5 per default
         # compute attention
 
         return rearrange(h_, "b 1 (h w) c -> b c h w", h=h, w=w, c=c, b=b)
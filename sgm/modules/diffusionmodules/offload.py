@@ -0,0 +1,120 @@
+import torch
+import torch.nn as nn
+
+
+class BlockOffload:
+    """
+    Low memory execution of UNet style models. The input/middle/output blocks are kept on the host
+    and streamed to the device one block at a time, while a block runs the block expected to run
+    next is copied on a side stream. Everything outside of the blocks stays resident on the device.
+
+    The next block is predicted from the order the blocks ran in before, so blocks skipped by the
+    feature caching or the control reuse are not prefetched once they have been skipped.
+    """
+
+    def __init__(self, models, device):
+        self.device = torch.device(device)
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
+        self.models = models
+        self.blocks = []
+        for model in models:
+            self.blocks.extend(model.input_blocks)
+            self.blocks.append(model.middle_block)
+            self.blocks.extend(getattr(model, "output_blocks", []))
+        self.block_modules = set(id(m) for block in self.blocks for m in block.modules())
+        # per block (tensor store, name, is parameter, host tensor)
+        self.host_tensors = [self.host_copy(block) for block in self.blocks]
+        # block index -> cuda event of its pending copy, None once usable on the compute stream
+        self.loaded = {}
+        self.current = None
+        self.successor = {}
+        self.hooks = []
+        for k, block in enumerate(self.blocks):
+            # hook the children, some output blocks of LightGLVUNet are run layer by layer
+            for child in block.children():
+                self.hooks.append(child.register_forward_pre_hook(lambda module, args, k=k: self.enter(k)))
+
+    def host_copy(self, block):
+        tensors = []
+        with torch.no_grad():
+            for module in block.modules():
+                for store, is_parameter in ((module._parameters, True), (module._buffers, False)):
+                    for name, t in store.items():
+                        if t is None:
+                            continue
+                        host = t.detach().to("cpu")
+                        if self.stream is not None:
+                            host = host.pin_memory()
+                        tensors.append((store, name, is_parameter, host))
+                        store[name] = nn.Parameter(host, requires_grad=False) if is_parameter else host
+        return tensors
+
+    def place(self):
+        """Moves everything outside of the blocks to the device"""
+        with torch.no_grad():
+            for model in self.models:
+                for module in model.modules():
+                    if id(module) in self.block_modules:
+                        continue
+                    for store, is_parameter in ((module._parameters, True), (module._buffers, False)):
+                        for name, t in store.items():
+                            if t is None or t.device == self.device:
+                                continue
+                            t = t.detach().to(self.device)
+                            store[name] = nn.Parameter(t, requires_grad=False) if is_parameter else t
+
+    def load(self, k):
+        with torch.inference_mode(False), torch.no_grad():
+            for store, name, is_parameter, host in self.host_tensors[k]:
+                t = host.to(self.device, non_blocking=True)
+                store[name] = nn.Parameter(t, requires_grad=False) if is_parameter else t
+
+    def release(self, k):
+        with torch.inference_mode(False):
+            for store, name, is_parameter, host in self.host_tensors[k]:
+                store[name] = nn.Parameter(host, requires_grad=False) if is_parameter else host
+        self.loaded.pop(k, None)
+
+    def release_all(self):
+        for k in range(len(self.blocks)):
+            self.release(k)
+        self.current = None
+
+    def prefetch(self, k):
+        if self.stream is None or k in self.loaded:
+            return
+        with torch.cuda.stream(self.stream):
+            self.load(k)
+            event = torch.cuda.Event()
+            event.record(self.stream)
+        self.loaded[k] = event
+
+    def enter(self, k):
+        if k == self.current:
+            return
+        if self.current is not None:
+            self.successor[self.current] = k
+            self.release(self.current)
+        if k not in self.loaded:
+            self.load(k)
+            self.loaded[k] = None
+        event = self.loaded[k]
+        if event is not None:
+            compute_stream = torch.cuda.current_stream(self.device)
+            compute_stream.wait_event(event)
+            # the copies were allocated on the side stream, keep them alive until the compute stream is done
+            for store, name, is_parameter, host in self.host_tensors[k]:
+                store[name].record_stream(compute_stream)
+            self.loaded[k] = None
+        self.current = k
+        next_k = self.successor.get(k, (k + 1) % len(self.blocks))
+        # drop mispredicted prefetches
+        for stale in [i for i in self.loaded if i != k and i != next_k]:
+            self.release(stale)
+        self.prefetch(next_k)
+
+    def remove(self):
+        for hook in self.hooks:
+            hook.remove()
+        self.hooks = []
+        self.release_all()
@@ -3,6 +3,7 @@
 """
 
 
+from functools import lru_cache
 from typing import Dict, Union
 
 import torch
@@ -18,6 +19,7 @@ from ...modules.diffusionmodules.sampling_utils import (
     to_sigma,
 )
 from ...util import append_dims, default, instantiate_from_config
+from ...modules.attention import set_sampling_step, set_sampling_tile, stacked_cat
 import copy
 
 DEFAULT_GUIDER = {"target": ".sgm.modules.diffusionmodules.guiders.IdentityGuider"}
@@ -33,8 +35,12 @@ class BaseDiffusionSampler:
         guider_config: Union[Dict, ListConfig, OmegaConf, None] = None,
         verbose: bool = False,
         device: str = "cuda",
+        denoise_strength: float = 1.0,
+        preview_every: int = 0,
     ):
         self.num_steps = num_steps
+        self.denoise_strength = denoise_strength
+        self.preview_every = preview_every
         self.discretization = instantiate_from_config(discretization_config)
         self.guider = instantiate_from_config(
             default(
@@ -58,12 +64,36 @@ class BaseDiffusionSampler:
 
         return x, s_in, sigmas, num_sigmas, cond, uc
 
+    def partial_denoise_start(self, x, sigmas, x_center=None):
+        """
+        With denoise_strength < 1 the start of the schedule is skipped, and sampling starts
+        from x_center noised to the new first sigma instead of from pure noise.
+        x is the noise as returned by prepare_sampling_loop, scaled for sigmas[0].
+        """
+        if x_center is None or self.denoise_strength >= 1.0:
+            return x, sigmas, len(sigmas)
+        start = min(int(round((1.0 - self.denoise_strength) * (len(sigmas) - 1))), len(sigmas) - 2)
+        x = x_center + x * (sigmas[start] / torch.sqrt(1.0 + sigmas[0] ** 2.0))
+        sigmas = sigmas[start:]
+        return x, sigmas, len(sigmas)
+
+    def preview_due(self, callback, i, num_sigmas):
+        """
+        True if the preview callback should receive the denoised latent of step i.
+        The callback returns the preview image, which is sent with the progress bar update of the step.
+        """
+        if callback is None or self.preview_every <= 0:
+            return False
+        return (i + 1) % self.preview_every == 0 or i == num_sigmas - 2
+
     def denoise(self, x, denoiser, sigma, cond, uc):
-        denoised = denoiser(*self.guider.prepare_inputs(x, sigma, cond, uc))
-        denoised = self.guider(denoised, sigma)
-        return denoised
+        return self.guider.guide(denoiser, x, sigma, cond, uc)
 
-    def get_sigma_gen(self, num_sigmas):
+    def get_sigma_gen(self, num_sigmas, sigmas=None):
+        # the guider gets the final schedule of the run, after any partial denoise or karras rescheduling,
+        # copied to the host once so the per step decisions don't sync with the device
+        host_sigmas = None if sigmas is None else sigmas.tolist()
+        self.guider.prepare_schedule(host_sigmas)
         sigma_generator = range(num_sigmas - 1)
         if self.verbose:
             print("#" * 30, " Sampling setting ", "#" * 30)
@@ -75,7 +105,18 @@ class BaseDiffusionSampler:
                 total=num_sigmas,
                 desc=f"Sampling with {self.__class__.__name__} for {num_sigmas} steps",
             )
-        return sigma_generator
+        return _published_steps(sigma_generator, self.guider, host_sigmas)
+
+
+def _published_steps(steps, guider, host_sigmas=None):
+    """
+    Publishes the index and sigma of each step to the run-scoped conditioning cache, the step based feature reuse
+    needs them, and the index to the guider for its per step decisions
+    """
+    for i in steps:
+        set_sampling_step(i, None if host_sigmas is None else host_sigmas[i])
+        guider.set_step(i)
+        yield i
 
 
 class SingleStepDiffusionSampler(BaseDiffusionSampler):
@@ -119,7 +160,7 @@ class EDMSampler(SingleStepDiffusionSampler):
             x, cond, uc, num_steps
         )
 
-        for i in self.get_sigma_gen(num_sigmas):
+        for i in self.get_sigma_gen(num_sigmas, sigmas):
             gamma = (
                 min(self.s_churn / (num_sigmas - 1), 2**0.5 - 1)
                 if self.s_tmin <= sigmas[i] <= self.s_tmax
@@ -165,7 +206,7 @@ class AncestralSampler(SingleStepDiffusionSampler):
             x, cond, uc, num_steps
         )
 
-        for i in self.get_sigma_gen(num_sigmas):
+        for i in self.get_sigma_gen(num_sigmas, sigmas):
             x = self.sampler_step(
                 s_in * sigmas[i],
                 s_in * sigmas[i + 1],
@@ -196,7 +237,7 @@ class LinearMultistepSampler(BaseDiffusionSampler):
 
         ds = []
         sigmas_cpu = sigmas.detach().cpu().numpy()
-        for i in self.get_sigma_gen(num_sigmas):
+        for i in self.get_sigma_gen(num_sigmas, sigmas):
             sigma = s_in * sigmas[i]
             denoised = denoiser(
                 *self.guider.prepare_inputs(x, sigma, cond, uc), **kwargs
@@ -356,7 +397,7 @@ class DPMPP2MSampler(BaseDiffusionSampler):
         )
 
         old_denoised = None
-        for i in self.get_sigma_gen(num_sigmas):
+        for i in self.get_sigma_gen(num_sigmas, sigmas):
             x, old_denoised = self.sampler_step(
                 old_denoised,
                 None if i == 0 else s_in * sigmas[i - 1],
@@ -395,11 +436,10 @@ class RestoreEDMSampler(SingleStepDiffusionSampler):
         self.restore_cfg = restore_cfg
         self.restore_cfg_s_tmin = restore_cfg_s_tmin
         self.sigma_max = 14.6146
+        self.last_denoised = None
 
     def denoise(self, x, denoiser, sigma, cond, uc, control_scale=1.0):
-        denoised = denoiser(*self.guider.prepare_inputs(x, sigma, cond, uc), control_scale)
-        denoised = self.guider(denoised, sigma)
-        return denoised
+        return self.guider.guide(denoiser, x, sigma, cond, uc, control_scale)
 
 
     def sampler_step(self, sigma, next_sigma, denoiser, x, cond, uc=None, gamma=0.0, x_center=None, eps_noise=None,
@@ -420,6 +460,8 @@ class RestoreEDMSampler(SingleStepDiffusionSampler):
         if (next_sigma[0] > self.restore_cfg_s_tmin) and (self.restore_cfg > 0):
             d_center = (denoised - x_center)
             denoised = denoised - d_center * ((sigma.view(-1, 1, 1, 1) / self.sigma_max) ** self.restore_cfg)
+        # kept for the preview callback
+        self.last_denoised = denoised
 
         d = to_d(x, sigma_hat, denoised)
         dt = append_dims(next_sigma - sigma_hat, x.ndim)
@@ -427,12 +469,13 @@ class RestoreEDMSampler(SingleStepDiffusionSampler):
         return x
 
     def __call__(self, denoiser, x, cond, uc=None, num_steps=None, x_center=None, control_scale=1.0,
-                 use_linear_control_scale=False, control_scale_start=0.0):
+                 use_linear_control_scale=False, control_scale_start=0.0, callback=None):
         x, s_in, sigmas, num_sigmas, cond, uc = self.prepare_sampling_loop(
             x, cond, uc, num_steps
         )
+        x, sigmas, num_sigmas = self.partial_denoise_start(x, sigmas, x_center)
         pbar_comfy = comfy.utils.ProgressBar(num_sigmas)
-        for _idx, i in enumerate(self.get_sigma_gen(num_sigmas)):
+        for _idx, i in enumerate(self.get_sigma_gen(num_sigmas, sigmas)):
             gamma = (
                 min(self.s_churn / (num_sigmas - 1), 2**0.5 - 1)
                 if self.s_tmin <= sigmas[i] <= self.s_tmax
@@ -451,24 +494,26 @@ class RestoreEDMSampler(SingleStepDiffusionSampler):
                 use_linear_control_scale=use_linear_control_scale,
                 control_scale_start=control_scale_start,
             )
-            pbar_comfy.update(1)
+            preview = callback(i, self.last_denoised, x, num_sigmas - 1) if self.preview_due(callback, i, num_sigmas) else None
+            pbar_comfy.update_absolute(pbar_comfy.current + 1, preview=preview)
+        self.last_denoised = None
         return x
 
 class TiledRestoreEDMSampler(RestoreEDMSampler):
-    def __init__(self, tile_size=128, tile_stride=64, *args, **kwargs):
+    def __init__(self, tile_size=128, tile_stride=64, tile_batch_size=1, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.tile_size = tile_size
         self.tile_stride = tile_stride
-        self.tile_weights = gaussian_weights(self.tile_size, self.tile_size, 1)
+        self.tile_batch_size = max(int(tile_batch_size), 1)
 
     def __call__(self, denoiser, x, cond, uc=None, num_steps=None, x_center=None, control_scale=1.0,
-                 use_linear_control_scale=False, control_scale_start=0.0):
+                 use_linear_control_scale=False, control_scale_start=0.0, callback=None):
         cond_copy = copy.deepcopy(cond)
         uc_copy = copy.deepcopy(uc)
         use_local_prompt = isinstance(cond_copy, list)
         b, _, h, w = x.shape
-        latent_tiles_iterator = _sliding_windows(h, w, self.tile_size, self.tile_stride)
-        tile_weights = self.tile_weights.repeat(b, 1, 1, 1)
+        plan = get_tile_plan(h, w, self.tile_size, self.tile_stride, x.dtype, x.device)
+        latent_tiles_iterator = plan.coords
         if not use_local_prompt:
             LQ_latent = cond_copy['control']
         else:
@@ -478,33 +523,39 @@ class TiledRestoreEDMSampler(RestoreEDMSampler):
         x, s_in, sigmas, num_sigmas, cond_copy, uc_copy = self.prepare_sampling_loop(
             x, cond_copy, uc_copy, num_steps
         )
+        x, sigmas, num_sigmas = self.partial_denoise_start(x, sigmas, clean_LQ_latent)
+        tile_batches = _batched_windows(latent_tiles_iterator, self.tile_batch_size)
+        tile_conds = _tile_conds(tile_batches, LQ_latent, cond_copy, uc_copy)
+        # x and x_next swap roles every step, so the blend needs no per step allocation
+        x_next = torch.empty_like(x)
+        denoised_preview = None
         pbar_comfy = comfy.utils.ProgressBar(num_sigmas)
-        for _idx, i in enumerate(self.get_sigma_gen(num_sigmas)):
+        for _idx, i in enumerate(self.get_sigma_gen(num_sigmas, sigmas)):
             gamma = (
                 min(self.s_churn / (num_sigmas - 1), 2**0.5 - 1)
                 if self.s_tmin <= sigmas[i] <= self.s_tmax
                 else 0.0
             )
-            x_next = torch.zeros_like(x)
-            count = torch.zeros_like(x)
+            x_next.zero_()
+            # the denoised tiles are only blended on the steps that are previewed
+            preview = self.preview_due(callback, i, num_sigmas)
+            if preview:
+                denoised_preview = torch.zeros_like(x) if denoised_preview is None else denoised_preview.zero_()
             eps_noise = torch.randn_like(x)
-            for j, (hi, hi_end, wi, wi_end) in enumerate(latent_tiles_iterator):
-                x_tile = x[:, :, hi:hi_end, wi:wi_end]
-                _eps_noise = eps_noise[:, :, hi:hi_end, wi:wi_end]
-                x_center_tile = clean_LQ_latent[:, :, hi:hi_end, wi:wi_end]
-                if use_local_prompt:
-                    _cond = cond_copy[j]
-                else:
-                    _cond = cond_copy
-                _cond['control'] = LQ_latent[:, :, hi:hi_end, wi:wi_end]
-                uc_copy['control'] = LQ_latent[:, :, hi:hi_end, wi:wi_end]
+            for tile_index, ((tile_ids, coords), (_cond, _uc)) in enumerate(zip(tile_batches, tile_conds)):
+                set_sampling_tile(tile_index)
+                # stack the tiles of this batch along the batch dim so the denoiser runs once for all of them
+                x_tile = _stack_tiles(x, coords)
+                _eps_noise = _stack_tiles(eps_noise, coords)
+                x_center_tile = _stack_tiles(clean_LQ_latent, coords)
+                s_in_tile = x_tile.new_ones([x_tile.shape[0]])
                 _x = self.sampler_step(
-                    s_in * sigmas[i],
-                    s_in * sigmas[i + 1],
+                    s_in_tile * sigmas[i],
+                    s_in_tile * sigmas[i + 1],
                     denoiser,
                     x_tile,
                     _cond,
-                    uc_copy,
+                    _uc,
                     gamma,
                     x_center_tile,
                     eps_noise=_eps_noise,
@@ -512,15 +563,21 @@ class TiledRestoreEDMSampler(RestoreEDMSampler):
                     use_linear_control_scale=use_linear_control_scale,
                     control_scale_start=control_scale_start,
                 )
-                x_next[:, :, hi:hi_end, wi:wi_end] += _x * tile_weights
-                count[:, :, hi:hi_end, wi:wi_end] += tile_weights
-            x_next /= count
-            x = x_next
-            pbar_comfy.update(1)
+                for (hi, hi_end, wi, wi_end), _x_tile in zip(coords, _x.split(b)):
+                    x_next[:, :, hi:hi_end, wi:wi_end].addcmul_(_x_tile, plan.weights)
+                if preview:
+                    for (hi, hi_end, wi, wi_end), _denoised_tile in zip(coords, self.last_denoised.split(b)):
+                        denoised_preview[:, :, hi:hi_end, wi:wi_end].addcmul_(_denoised_tile, plan.weights)
+            x_next *= plan.inv_count
+            x, x_next = x_next, x
+            preview_image = callback(i, denoised_preview.mul_(plan.inv_count), x, num_sigmas - 1) if preview else None
+            pbar_comfy.update_absolute(pbar_comfy.current + 1, preview=preview_image)
+        set_sampling_tile(None)
+        self.last_denoised = None
         return x
 
 
-def gaussian_weights(tile_width, tile_height, nbatches):
+def gaussian_weights(tile_width, tile_height, nbatches, dtype=torch.float32, device=device):
     """Generates a gaussian mask of weights for tile contributions"""
     from numpy import pi, exp, sqrt
     import numpy as np
@@ -535,13 +592,29 @@ def gaussian_weights(tile_width, tile_height, nbatches):
     midpoint = latent_height / 2
     y_probs = [exp(-(y - midpoint) * (y - midpoint) / (latent_height * latent_height) / (2 * var)) / sqrt(2 * pi * var)
                for y in range(latent_height)]
-    
-    if comfy.model_management.is_device_mps(device):
-        weights = np.outer(y_probs, x_probs).astype(np.float32)
-    else:
-        weights = np.outer(y_probs, x_probs)
-   
-    return torch.tile(torch.tensor(weights, device=device), (nbatches, 4, 1, 1))
+
+    # cast on the host so no float64 tensor ends up on the device (MPS has no float64 at all)
+    weights = np.outer(y_probs, x_probs)
+    return torch.tile(torch.tensor(weights, dtype=dtype, device=device), (nbatches, 4, 1, 1))
+
+
+class TilePlan:
+    """Tile layout of a latent: window coords, blend weights and the reciprocal of the summed weights"""
+    def __init__(self, h, w, tile_size, tile_stride, dtype, device):
+        self.coords = _sliding_windows(h, w, tile_size, tile_stride)
+        # single channel, broadcasts over the batch and latent channels
+        weights = gaussian_weights(tile_size, tile_size, 1, device=device)[:, :1]
+        count = torch.zeros((1, 1, h, w), dtype=weights.dtype, device=device)
+        for hi, hi_end, wi, wi_end in self.coords:
+            count[:, :, hi:hi_end, wi:wi_end] += weights
+        self.weights = weights.to(dtype)
+        self.inv_count = count.reciprocal_().to(dtype)
+
+
+@lru_cache(maxsize=8)
+def get_tile_plan(h, w, tile_size, tile_stride, dtype, device):
+    """Returns the TilePlan for this layout, plans are reused across sampler runs"""
+    return TilePlan(h, w, tile_size, tile_stride, dtype, device)
 
 
 def _sliding_windows(h: int, w: int, tile_size: int, tile_stride: int):
@@ -559,6 +632,55 @@ def _sliding_windows(h: int, w: int, tile_size: int, tile_stride: int):
             coords.append((hi, hi + tile_size, wi, wi + tile_size))
     return coords
 
+
+def _batched_windows(coords, tile_batch_size):
+    """Groups the sliding window coords into batches of (tile indices, coords)"""
+    batches = []
+    for start in range(0, len(coords), tile_batch_size):
+        end = min(start + tile_batch_size, len(coords))
+        batches.append((list(range(start, end)), coords[start:end]))
+    return batches
+
+
+def _stack_tiles(t, coords):
+    return torch.cat([t[:, :, hi:hi_end, wi:wi_end] for hi, hi_end, wi, wi_end in coords], dim=0)
+
+
+def stack_conds(conds, control=None):
+    """
+    Concatenates per tile or per image conditionings along the batch dim, replacing the control latent if given.
+    A single conditioning without a new control latent is returned as it is.
+    """
+    if len(conds) == 1 and control is None:
+        return conds[0]
+    c_out = dict()
+    for k in conds[0]:
+        if k == 'control' and control is not None:
+            c_out[k] = control
+        elif isinstance(conds[0][k], torch.Tensor):
+            # the parts are recorded, so the K/V cache holds one projection per distinct prompt, not per stack
+            c_out[k] = stacked_cat([c[k] for c in conds], 0)
+        else:
+            c_out[k] = conds[0][k]
+    return c_out
+
+
+def _tile_conds(tile_batches, control, cond, uc):
+    """
+    Stacked (cond, uc) of each tile batch, with the control latent cropped to the tiles.
+    cond is a list with one local prompt per tile or a single conditioning shared by all tiles.
+    The result is the same on every step, so the samplers build it once per run.
+    """
+    tile_conds = []
+    for tile_ids, coords in tile_batches:
+        control_tile = _stack_tiles(control, coords)
+        if isinstance(cond, list):
+            _cond = stack_conds([cond[j] for j in tile_ids], control_tile)
+        else:
+            _cond = stack_conds([cond] * len(coords), control_tile)
+        tile_conds.append((_cond, stack_conds([uc] * len(coords), control_tile)))
+    return tile_conds
+
 class RestoreDPMPP2MSampler(DPMPP2MSampler):
     def __init__(self, s_churn=0.0, s_tmin=0.0, s_tmax=float("inf"), s_noise=1.0, restore_cfg=4.0,
             restore_cfg_s_tmin=0.05, eta=1., *args, **kwargs):
@@ -570,9 +692,7 @@ class RestoreDPMPP2MSampler(DPMPP2MSampler):
         super().__init__(*args, **kwargs)
 
     def denoise(self, x, denoiser, sigma, cond, uc, control_scale=1.0):
-        denoised = denoiser(*self.guider.prepare_inputs(x, sigma, cond, uc), control_scale)
-        denoised = self.guider(denoised, sigma)
-        return denoised
+        return self.guider.guide(denoiser, x, sigma, cond, uc, control_scale)
 
     def get_mult(self, h, r, t, t_next, previous_sigma):
         eta_h = self.eta * h
@@ -637,19 +757,20 @@ class RestoreDPMPP2MSampler(DPMPP2MSampler):
         return x, denoised
 
     def __call__(self, denoiser, x, cond, uc=None, num_steps=None, x_center=None, control_scale=1.0, 
-                 use_linear_control_scale=False, control_scale_start=0.0, **kwargs):
+                 use_linear_control_scale=False, control_scale_start=0.0, callback=None, **kwargs):
         x, s_in, sigmas, num_sigmas, cond, uc = self.prepare_sampling_loop(
             x, cond, uc, num_steps
         )
         sigmas_min, sigmas_max = sigmas[-2].cpu(), sigmas[0].cpu()
         sigmas_new = get_sigmas_karras(self.num_steps, sigmas_min, sigmas_max, device=x.device)
         sigmas = sigmas_new
+        x, sigmas, num_sigmas = self.partial_denoise_start(x, sigmas, x_center)
 
         noise_sampler = BrownianTreeNoiseSampler(x, sigmas_min, sigmas_max)
 
         old_denoised = None
         pbar_comfy = comfy.utils.ProgressBar(num_sigmas)
-        for i in self.get_sigma_gen(num_sigmas):
+        for i in self.get_sigma_gen(num_sigmas, sigmas):
             if i > 0 and torch.sum(s_in * sigmas[i + 1]) > 1e-14:
                 eps_noise = noise_sampler(s_in * sigmas[i], s_in * sigmas[i + 1])
             else:
@@ -669,27 +790,28 @@ class RestoreDPMPP2MSampler(DPMPP2MSampler):
                 use_linear_control_scale=use_linear_control_scale,
                 control_scale_start=control_scale_start,
             )
-            pbar_comfy.update(1)
+            preview = callback(i, old_denoised, x, num_sigmas - 1) if self.preview_due(callback, i, num_sigmas) else None
+            pbar_comfy.update_absolute(pbar_comfy.current + 1, preview=preview)
 
         return x
    
 class TiledRestoreDPMPP2MSampler(RestoreDPMPP2MSampler):
-    def __init__(self, tile_size=128, tile_stride=64, *args, **kwargs):
+    def __init__(self, tile_size=128, tile_stride=64, tile_batch_size=1, *args, **kwargs):
         
         super().__init__(*args, **kwargs)
         self.tile_size = tile_size
         self.tile_stride = tile_stride
-        self.tile_weights = gaussian_weights(self.tile_size, self.tile_size, 1)
+        self.tile_batch_size = max(int(tile_batch_size), 1)
 
-    def __call__(self, denoiser, x, cond, uc=None, num_steps=None, control_scale=1.0, **kwargs):
+    def __call__(self, denoiser, x, cond, uc=None, num_steps=None, control_scale=1.0, callback=None, **kwargs):
         use_local_prompt = isinstance(cond, list)
         b, _, h, w = x.shape
-        latent_tiles_iterator = _sliding_windows(h, w, self.tile_size, self.tile_stride)
+        plan = get_tile_plan(h, w, self.tile_size, self.tile_stride, x.dtype, x.device)
+        latent_tiles_iterator = plan.coords
         print(f"Image divided into {len(latent_tiles_iterator)} tiles")
         print("Conds received: ", len(cond))
         cond_copy = copy.deepcopy(cond)
         uc_copy = copy.deepcopy(uc)
-        tile_weights = self.tile_weights.repeat(b, 1, 1, 1)
         if not use_local_prompt:
             LQ_latent = cond['control']
         else:
@@ -702,50 +824,56 @@ class TiledRestoreDPMPP2MSampler(RestoreDPMPP2MSampler):
         sigmas_min, sigmas_max = sigmas[-2].cpu(), sigmas[0].cpu()
         sigmas_new = get_sigmas_karras(self.num_steps, sigmas_min, sigmas_max, device=x.device)
         sigmas = sigmas_new
+        x, sigmas, num_sigmas = self.partial_denoise_start(x, sigmas, kwargs.get('x_center', None))
 
         noise_sampler = BrownianTreeNoiseSampler(x, sigmas_min, sigmas_max)
 
+        tile_batches = _batched_windows(latent_tiles_iterator, self.tile_batch_size)
+        tile_conds = _tile_conds(tile_batches, LQ_latent, cond_copy, uc_copy)
         old_denoised = None
+        # the blend targets swap with x / old_denoised every step, so they are only allocated once
+        x_next = torch.empty_like(x)
+        old_denoised_next = torch.empty_like(x)
         pbar_comfy = comfy.utils.ProgressBar(num_sigmas)
-        for _idx, i in enumerate(self.get_sigma_gen(num_sigmas)):
+        for _idx, i in enumerate(self.get_sigma_gen(num_sigmas, sigmas)):
             if i > 0 and torch.sum(s_in * sigmas[i + 1]) > 1e-14:
                 eps_noise = noise_sampler(s_in * sigmas[i], s_in * sigmas[i + 1])
             else:
                 eps_noise = torch.zeros_like(x)
-            x_next = torch.zeros_like(x)
-            old_denoised_next = torch.zeros_like(x)
-            count = torch.zeros_like(x)
-            for j, (hi, hi_end, wi, wi_end) in enumerate(latent_tiles_iterator):
-                x_tile = x[:, :, hi:hi_end, wi:wi_end]
-                _eps_noise = eps_noise[:, :, hi:hi_end, wi:wi_end]
+            x_next.zero_()
+            old_denoised_next.zero_()
+            for tile_index, ((tile_ids, coords), (_cond, _uc)) in enumerate(zip(tile_batches, tile_conds)):
+                set_sampling_tile(tile_index)
+                # stack the tiles of this batch along the batch dim so the denoiser runs once for all of them
+                x_tile = _stack_tiles(x, coords)
+                _eps_noise = _stack_tiles(eps_noise, coords)
                 if old_denoised is not None:
-                    old_denoised_tile = old_denoised[:, :, hi:hi_end, wi:wi_end]
+                    old_denoised_tile = _stack_tiles(old_denoised, coords)
                 else:
                     old_denoised_tile = None
-                if use_local_prompt:
-                    _cond = cond_copy[j]
-                else:
-                    _cond = cond_copy
-                _cond['control'] = LQ_latent[:, :, hi:hi_end, wi:wi_end]
-                uc_copy['control'] = LQ_latent[:, :, hi:hi_end, wi:wi_end]
+                s_in_tile = x_tile.new_ones([x_tile.shape[0]])
                 _x, _old_denoised = self.sampler_step(
                     old_denoised_tile,
-                    None if i == 0 else s_in * sigmas[i - 1],
-                    s_in * sigmas[i],
-                    s_in * sigmas[i + 1],
+                    None if i == 0 else s_in_tile * sigmas[i - 1],
+                    s_in_tile * sigmas[i],
+                    s_in_tile * sigmas[i + 1],
                     denoiser,
                     x_tile,
                     _cond,
-                    uc=uc_copy,
+                    uc=_uc,
                     eps_noise=_eps_noise,
                     control_scale=control_scale,
                 )
-                x_next[:, :, hi:hi_end, wi:wi_end] += _x * tile_weights
-                old_denoised_next[:, :, hi:hi_end, wi:wi_end] += _old_denoised * tile_weights
-                count[:, :, hi:hi_end, wi:wi_end] += tile_weights
-            old_denoised_next /= count
-            x_next /= count
-            x = x_next
-            old_denoised = old_denoised_next
-            pbar_comfy.update(1)
+                for (hi, hi_end, wi, wi_end), _x_tile, _old_denoised_tile in zip(coords, _x.split(b), _old_denoised.split(b)):
+                    x_next[:, :, hi:hi_end, wi:wi_end].addcmul_(_x_tile, plan.weights)
+                    old_denoised_next[:, :, hi:hi_end, wi:wi_end].addcmul_(_old_denoised_tile, plan.weights)
+            old_denoised_next *= plan.inv_count
+            x_next *= plan.inv_count
+            x, x_next = x_next, x
+            if old_denoised is None:
+                old_denoised = torch.empty_like(x)
+            old_denoised, old_denoised_next = old_denoised_next, old_denoised
+            preview = callback(i, old_denoised, x, num_sigmas - 1) if self.preview_due(callback, i, num_sigmas) else None
+            pbar_comfy.update_absolute(pbar_comfy.current + 1, preview=preview)
+        set_sampling_tile(None)
         return x
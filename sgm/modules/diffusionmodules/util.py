@@ -19,6 +19,19 @@ import comfy.model_management
 device = comfy.model_management.get_torch_device()
 from contextlib import nullcontext
 
+# set by the model loaders, disables gradient checkpointing and samples under torch.inference_mode()
+_inference_mode = False
+
+
+def set_inference_mode(enabled=True):
+    global _inference_mode
+    _inference_mode = enabled
+
+
+def inference_mode_enabled():
+    return _inference_mode
+
+
 def make_beta_schedule(
     schedule,
     n_timestep,
@@ -53,7 +66,7 @@ def mixed_checkpoint(func, inputs: dict, params, flag):
                    explicitly take as arguments.
     :param flag: if False, disable gradient checkpointing.
     """
-    if flag:
+    if flag and not _inference_mode:
         tensor_keys = [key for key in inputs if isinstance(inputs[key], torch.Tensor)]
         tensor_inputs = [
             inputs[key] for key in inputs if isinstance(inputs[key], torch.Tensor)
@@ -163,7 +176,7 @@ def checkpoint(func, inputs, params, flag):
                    explicitly take as arguments.
     :param flag: if False, disable gradient checkpointing.
     """
-    if flag:
+    if flag and not _inference_mode:
         args = tuple(inputs) + tuple(params)
         return CheckpointFunction.apply(func, len(inputs), *args)
     else:
@@ -252,6 +265,16 @@ def scale_module(module, scale):
     return module
 
 
+def memory_format(x):
+    """
+    Memory format of a 4D tensor, channels_last tensors are kept channels_last when reshaped back
+    from tokens instead of being copied to NCHW.
+    """
+    if not x.is_contiguous() and x.is_contiguous(memory_format=torch.channels_last):
+        return torch.channels_last
+    return torch.contiguous_format
+
+
 def mean_flat(tensor):
     """
     Take the mean over all non-batch dimensions.
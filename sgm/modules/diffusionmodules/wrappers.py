@@ -5,6 +5,10 @@ from packaging import version
 # torch._dynamo.config.suppress_errors = True
 # torch._dynamo.config.cache_size_limit = 512
 
+from .util import timestep_embedding
+from .offload import BlockOffload
+from ..attention import cached_call, cached_step_state, sampling_sigma, sampling_tile
+
 OPENAIUNETWRAPPER = ".sgm.modules.diffusionmodules.wrappers.OpenAIWrapper"
 import comfy.model_management
 from contextlib import nullcontext
@@ -79,20 +83,83 @@ class ControlWrapper(nn.Module):
         self.diffusion_model = self.compile(diffusion_model)
         self.control_model = None
         self.dtype = dtype
+        # control features are only recomputed every control_reuse_interval steps
+        # at sigmas up to control_reuse_max_sigma, other steps reuse the last ones
+        self.control_reuse_interval = 1
+        self.control_reuse_max_sigma = float("inf")
+        self.block_offload = None
+        # run both networks in channels_last, the weights are converted by the loader
+        self.channels_last = False
 
     def load_control_model(self, control_model):
         self.control_model = self.compile(control_model)
 
+    def enable_block_offload(self, device):
+        """
+        Low memory mode, the blocks of the UNet and control model stay on the host and are streamed
+        to the device while sampling, the rest of both models is moved to the device. See BlockOffload.
+        """
+        if self.block_offload is None or self.block_offload.device != torch.device(device):
+            self.disable_block_offload()
+            self.block_offload = BlockOffload([self.control_model, self.diffusion_model], device)
+        # the models may have been moved since the last run
+        self.block_offload.release_all()
+        self.block_offload.place()
+
+    def disable_block_offload(self):
+        if self.block_offload is not None:
+            self.block_offload.remove()
+            self.block_offload = None
+
+    def control_reuse_lookup(self, c):
+        """
+        Returns the control reuse state of this conditioning and whether its stored control is reused this step.
+        Needs the run-scoped conditioning cache, otherwise control is computed on every step.
+        The stored control is only reused on the steps directly following the one it was computed on,
+        see cached_step_state. The tiled samplers keep one stored control per tile batch, so it holds
+        the full control output of every tile batch for the run.
+        The sigma threshold is compared against the host sigma the sampling loop publishes, not t,
+        so the check doesn't sync with the device.
+        """
+        if self.control_reuse_interval <= 1:
+            return None, False
+        sigma = sampling_sigma()
+        return cached_step_state(("control_reuse", id(self), sampling_tile()), (c.get("crossattn", None),),
+                                 self.control_reuse_interval, "control",
+                                 allow_reuse=sigma is None or sigma <= self.control_reuse_max_sigma)
+
     def forward(
             self, x: torch.Tensor, t: torch.Tensor, c: dict, control_scale=1, **kwargs
     ) -> torch.Tensor:
         autocast_condition = (self.dtype == torch.float16 or self.dtype == torch.bfloat16) and not comfy.model_management.is_device_mps(device)
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+            control_hint = c.get("control", None)
+            if control_hint is not None:
+                # the hint is constant during sampling, convert it once per run
+                c = {**c, "control": cached_call(("channels_last",), (control_hint,),
+                                                 lambda: control_hint.contiguous(memory_format=torch.channels_last))}
         with torch.autocast(comfy.model_management.get_autocast_device(device), dtype=self.dtype) if autocast_condition else nullcontext():
-            control = self.control_model(x=c.get("control", None), timesteps=t, xt=x,
-                                         control_vector=c.get("control_vector", None),
-                                         mask_x=c.get("mask_x", None),
-                                         context=c.get("crossattn", None),
-                                         y=c.get("vector", None))
+            # the sinusoidal timestep embedding is parameter free, compute it once for both networks
+            t_emb = None
+            if self.control_model.model_channels == self.diffusion_model.model_channels:
+                t_emb = timestep_embedding(t, self.diffusion_model.model_channels, repeat_only=False)
+            # on feature cached steps the control model only has to provide the shallow features
+            deep_cache, use_deep_cache = self.diffusion_model.deep_cache_lookup(c.get("crossattn", None))
+            num_blocks = self.diffusion_model.deep_cache_depth if use_deep_cache else None
+            reuse_state, reuse_control = self.control_reuse_lookup(c)
+            if reuse_control:
+                control = reuse_state["control"][:num_blocks]
+            else:
+                control = self.control_model(x=c.get("control", None), timesteps=t, xt=x,
+                                             control_vector=c.get("control_vector", None),
+                                             mask_x=c.get("mask_x", None),
+                                             context=c.get("crossattn", None),
+                                             y=c.get("vector", None),
+                                             t_emb=t_emb,
+                                             num_blocks=num_blocks)
+                if reuse_state is not None and num_blocks is None:
+                    reuse_state["control"] = control
             out = self.diffusion_model(
                 x,
                 timesteps=t,
@@ -100,7 +167,11 @@ class ControlWrapper(nn.Module):
                 y=c.get("vector", None),
                 control=control,
                 control_scale=control_scale,
+                t_emb=t_emb,
+                deep_cache=deep_cache,
+                use_deep_cache=use_deep_cache,
                 **kwargs,
             )
-        return out.float()
+        # the samplers work in NCHW, converted together with the cast to float
+        return out.to(dtype=torch.float32, memory_format=torch.contiguous_format)
 